@@ -1,3 +1,11 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+
 import torch
 import PIL
 import requests
@@ -27,6 +35,10 @@ from diffusers.schedulers import DDIMScheduler, DPMSolverMultistepScheduler
 from diffusers.image_processor import PipelineImageInput
 
 from diffusers import LEditsPPPipelineStableDiffusionXL
+from diffusers.pipelines.ledits_pp.pipeline_leditspp_stable_diffusion_xl import (
+    LeditsAttentionStore,
+    LeditsGaussianSmoothing,
+)
 from diffusers.utils import (
     USE_PEFT_BACKEND,
     is_invisible_watermark_available,
@@ -90,7 +102,414 @@ def Fourier_filter(x, scale_low=1.0, scale_high=1.5, freq_cutoff=20):
     
     return x_filtered
 
+
+class LEditsInversionCache:
+    """
+    Content-addressed on-disk cache of `invert` results, so that repeated edits of the same image skip inversion.
+
+    Entries are keyed by the input image and every setting that influences the inversion, see `make_key`. Each
+    entry is a directory holding `zs`, `init_latents` and `inversion_steps` as `.npy` files, which are memory-mapped
+    when loaded, the resized input and VAE reconstruction images as PNG, and a `meta.json`. The least recently used
+    entries are evicted once the cache exceeds `max_bytes`.
+
+    Args:
+        cache_dir (`str`):
+            Directory of the cache, created if missing.
+        max_bytes (`int`, *optional*, defaults to 20 GiB):
+            Size limit of all entries together.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 20 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(image: PipelineImageInput, **settings) -> str:
+        """
+        Hash of the input image(s) and all settings that influence the inversion.
+        """
+        h = hashlib.sha256()
+
+        def update(img):
+            if isinstance(img, (list, tuple)):
+                for i in img:
+                    update(i)
+                return
+            if isinstance(img, PIL.Image.Image):
+                h.update(f"{img.mode}|{img.size}".encode())
+                img = np.asarray(img)
+            elif isinstance(img, torch.Tensor):
+                img = img.detach().float().cpu().numpy()
+            h.update(f"{img.shape}|{img.dtype}".encode())
+            h.update(np.ascontiguousarray(img).data)
+
+        update(image)
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up an inversion. Returns `None` on a miss, otherwise a dict with the `zs`, `init_latents` and
+        `inversion_steps` tensors (backed by copy-on-write memory maps), the `images` and `vae_reconstruction_images`
+        lists and the `meta` dict. `vae_reconstruction_images` is `None` if the entry was stored without them.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+            tensors = {
+                name: torch.from_numpy(np.load(os.path.join(entry, f"{name}.npy"), mmap_mode="c"))
+                for name in ("zs", "init_latents", "inversion_steps")
+            }
+            images, image_rec = [], []
+            for i in range(meta["batch_size"]):
+                images.append(Image.open(os.path.join(entry, f"image_{i}.png")).convert("RGB"))
+                if meta.get("vae_reconstruction", True):
+                    image_rec.append(Image.open(os.path.join(entry, f"reconstruction_{i}.png")).convert("RGB"))
+            if not meta.get("vae_reconstruction", True):
+                image_rec = None
+        except (OSError, ValueError, KeyError):
+            return None
+        # mark as recently used
+        os.utime(entry)
+        return dict(**tensors, images=images, vae_reconstruction_images=image_rec, meta=meta)
+
+    def put(
+        self,
+        key: str,
+        zs: torch.Tensor,
+        init_latents: torch.Tensor,
+        inversion_steps: torch.Tensor,
+        images: List[PIL.Image.Image],
+        vae_reconstruction_images: Optional[List[PIL.Image.Image]],
+        **meta,
+    ):
+        """
+        Store an inversion, replacing an existing entry of the same key, then evict least recently used entries beyond
+        `max_bytes`. Additional keyword arguments are stored in `meta.json`.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            for name, tensor in (("zs", zs), ("init_latents", init_latents), ("inversion_steps", inversion_steps)):
+                tensor = tensor.detach().cpu()
+                if tensor.dtype == torch.bfloat16:
+                    tensor = tensor.float()
+                np.save(os.path.join(tmp_entry, f"{name}.npy"), tensor.numpy())
+            for i, img in enumerate(images):
+                img.save(os.path.join(tmp_entry, f"image_{i}.png"))
+                if vae_reconstruction_images is not None:
+                    vae_reconstruction_images[i].save(os.path.join(tmp_entry, f"reconstruction_{i}.png"))
+            meta = dict(
+                meta,
+                batch_size=len(images),
+                dtype=str(init_latents.dtype).split(".")[-1],
+                vae_reconstruction=vae_reconstruction_images is not None,
+            )
+            with open(os.path.join(tmp_entry, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            # e.g. an entry stored without reconstructions
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # entry written concurrently by another process, or disk full
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".tmp-") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except OSError:
+                continue
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+class LEditsGuidanceRecorder:
+    """
+    Host-side record of the semantic guidance and activation masks of an edit, see `record_guidance` of the pipeline
+    call.
+
+    Storage for all steps is allocated up front, pinned on CUDA, and each step is written with non-blocking
+    device-to-host copies, so that recording does not synchronize the denoising loop. `finalize` waits for the
+    outstanding copies. In `"full"` mode guidance and masks are stored in float32. In `"compact"` mode the guidance is
+    stored in float16 and the masks, which are binary and equal across latent channels, with one bit per pixel, see
+    `unpack_masks`.
+
+    Args:
+        mode (`str`):
+            `"full"` or `"compact"`.
+        num_steps (`int`):
+            Number of denoising steps.
+        num_concepts (`int`):
+            Number of editing prompts.
+        shape (`Tuple[int, ...]`):
+            Shape of the guidance of one step, [B, C, H, W].
+        device (`torch.device`):
+            Device the recorded tensors come from.
+    """
+
+    def __init__(self, mode: str, num_steps: int, num_concepts: int, shape: Tuple[int, ...], device: torch.device):
+        if mode not in ("full", "compact"):
+            raise ValueError(f"Unknown `record_guidance`: {mode}, expected `None`, 'full' or 'compact'.")
+        self.mode = mode
+        self.shape = tuple(shape)
+        self.device = torch.device(device)
+        self.non_blocking = self.device.type == "cuda"
+        batch_size, _, height, width = self.shape
+        pin = self.non_blocking
+        if mode == "full":
+            self.sem_guidance = torch.zeros((num_steps, *self.shape), pin_memory=pin)
+            self.masks = torch.zeros((num_steps, num_concepts, *self.shape), pin_memory=pin)
+        else:
+            self.num_bits = batch_size * height * width
+            self.sem_guidance = torch.zeros((num_steps, *self.shape), dtype=torch.float16, pin_memory=pin)
+            self.masks = torch.zeros(
+                (num_steps, num_concepts, (self.num_bits + 7) // 8), dtype=torch.uint8, pin_memory=pin
+            )
+            self._bit_weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=self.device)
+
+    def record_guidance(self, step: int, guidance: torch.Tensor):
+        """
+        Record the summed edit guidance of `step`, with the shape of [B, C, H, W].
+        """
+        guidance = guidance.detach().to(self.sem_guidance.dtype)
+        self.sem_guidance[step].copy_(guidance, non_blocking=self.non_blocking)
+
+    def record_masks(self, step: int, concepts: List[int], masks: torch.Tensor):
+        """
+        Record the activation masks of `concepts` at `step`, with the shape of [len(concepts), B, C, H, W].
+        """
+        masks = masks.detach()
+        if self.mode == "compact":
+            bits = (masks[:, :, 0] > 0).flatten(start_dim=1)
+            bits = F.pad(bits, (0, 8 * self.masks.shape[-1] - self.num_bits)).view(len(concepts), -1, 8)
+            masks = (bits.to(torch.uint8) * self._bit_weights).sum(dim=-1, dtype=torch.uint8)
+        else:
+            masks = masks.to(self.masks.dtype)
+        for k, c in enumerate(concepts):
+            self.masks[step, c].copy_(masks[k], non_blocking=self.non_blocking)
+
+    def finalize(self):
+        """
+        Wait for the outstanding copies, after which the recorded tensors can be read.
+        """
+        if self.non_blocking:
+            torch.cuda.current_stream(self.device).synchronize()
+
+    def unpack_masks(self, step: Optional[int] = None) -> torch.Tensor:
+        """
+        Activation masks as float32, with the shape of [num_steps, num_concepts, B, C, H, W], or of
+        [num_concepts, B, C, H, W] for a single `step`.
+        """
+        masks = self.masks if step is None else self.masks[step]
+        if self.mode == "full":
+            return masks
+        shifts = torch.arange(7, -1, -1, dtype=torch.uint8)
+        bits = (masks[..., None] >> shifts) & 1
+        bits = bits.flatten(start_dim=-2)[..., : self.num_bits]
+        batch_size, channels, height, width = self.shape
+        bits = bits.view(*masks.shape[:-1], batch_size, 1, height, width)
+        return bits.float().expand(*masks.shape[:-1], batch_size, channels, height, width)
+
+
+class LEditsCrossAttnCapture:
+    """
+    Accumulator of the cross-attention maps of the editing prompts, used for cross-attention masks in place of the
+    `LeditsAttentionStore`.
+
+    Only the layers at the mask resolution are hooked, see `LEditsCrossAttnCaptureProcessor`. Each layer reduces its
+    attention probabilities over the heads and over the tokens of each editing prompt and adds the result in place to
+    a buffer of [num_concepts, B, H * W] on the device, so no per-layer maps are kept. `aggregate` turns the buffer
+    into the head- and layer-averaged maps of all concepts once per step.
+
+    Args:
+        num_edit_tokens (`List[int]`):
+            Number of tokens of each editing prompt, excluding the start token.
+        seq_len (`int`):
+            Length of the text embeddings.
+        batch_size (`int`):
+            Number of images.
+        resolution (`Tuple[int, int]`):
+            Resolution of the captured maps.
+        device (`torch.device`):
+            Device of the UNet.
+    """
+
+    def __init__(
+        self,
+        num_edit_tokens: List[int],
+        seq_len: int,
+        batch_size: int,
+        resolution: Tuple[int, int],
+        device: torch.device,
+    ):
+        num_concepts = len(num_edit_tokens)
+        self.token_weights = torch.zeros((num_concepts, seq_len), device=device)
+        for c, n in enumerate(num_edit_tokens):
+            if 1 + n > seq_len:
+                raise ValueError(
+                    f"Incorrect shape of attention_map. Expected size {n}, but found {max(seq_len - 1, 0)}!"
+                )
+            # 0 -> startoftext
+            self.token_weights[c, 1 : 1 + n] = 1.0
+        self.batch_size = batch_size
+        self.resolution = tuple(resolution)
+        self.maps = torch.zeros((num_concepts, batch_size, resolution[0] * resolution[1]), device=device)
+        self.num_maps = 0
+
+    def __call__(self, attention_probs: torch.Tensor, heads: int):
+        num_concepts = self.token_weights.shape[0]
+        rows, num_pixels, seq_len = attention_probs.shape
+        if num_pixels != self.maps.shape[-1] or rows != (1 + num_concepts) * self.batch_size * heads:
+            # other resolutions, or a UNet batch without the editing prompts
+            return
+        # rows are ordered as [prompt, image, head], the unconditional prompt comes first
+        probs = attention_probs.view(1 + num_concepts, self.batch_size, heads, num_pixels, seq_len)[1:]
+        maps = torch.einsum("cbhpt,ct->cbp", probs, self.token_weights.to(probs.dtype))
+        self.maps.add_(maps)
+        self.num_maps += heads
+
+    def aggregate(self) -> torch.Tensor:
+        """
+        Averaged maps of the current step, with the shape of [num_concepts, B, H, W].
+        """
+        maps = self.maps / max(self.num_maps, 1)
+        return maps.view(*maps.shape[:2], *self.resolution)
+
+    def reset(self):
+        self.maps.zero_()
+        self.num_maps = 0
+
+
+class LEditsCrossAttnCaptureProcessor:
+    """
+    Cross-attention processor that feeds the attention probabilities to a `LEditsCrossAttnCapture`.
+    """
+
+    def __init__(self, capture: LEditsCrossAttnCapture):
+        self.capture = capture
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states,
+        encoder_hidden_states,
+        attention_mask=None,
+        temb=None,
+    ):
+        batch_size, sequence_length, _ = (
+            hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+        )
+        attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+
+        query = attn.to_q(hidden_states)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        attention_probs = attn.get_attention_scores(query, key, attention_mask)
+        self.capture(attention_probs, attn.heads)
+
+        hidden_states = torch.bmm(attention_probs, value)
+        hidden_states = attn.batch_to_head_dim(hidden_states)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+        return hidden_states
+
+
+@dataclass
+class LEditsPPInversionState:
+    """
+    Inversion of one or more images of the same size, holding everything an edit needs instead of the pipeline
+    attributes set by `invert`. Returned by `invert_many` and `inversion_state`.
+
+    Args:
+        init_latents (`torch.Tensor`):
+            Inverted latents, with the shape of [B, C, H, W].
+        zs (`torch.Tensor`):
+            Noise maps in the order of the edit loop, with the shape of [num_inversion_steps, B, C, H, W], on the
+            device or offloaded, see `zs_offload` of `invert`.
+        inversion_steps (`torch.Tensor`):
+            Timesteps of the inversion.
+        num_scheduler_steps (`int`):
+            Number of timesteps the scheduler is set to, including the skipped ones.
+        size (`Tuple[int, int]`):
+            Image size as (height, width).
+        eta (`float`, *optional*, defaults to 1.0):
+            Scheduler eta of the inversion.
+        images (`List[PIL.Image.Image]`, *optional*):
+            Resized input images.
+        vae_reconstruction_images (`List[PIL.Image.Image]`, *optional*):
+            VAE reconstructions of the input images.
+    """
+
+    init_latents: torch.Tensor
+    zs: torch.Tensor
+    inversion_steps: torch.Tensor
+    num_scheduler_steps: int
+    size: Tuple[int, int]
+    eta: float = 1.0
+    images: Optional[List[PIL.Image.Image]] = None
+    vae_reconstruction_images: Optional[List[PIL.Image.Image]] = None
+
+    @property
+    def batch_size(self) -> int:
+        return self.init_latents.shape[0]
+
+
+@dataclass
+class LEditsPPEditRequest:
+    """
+    One edit for `edit_many`: an inversion and the edit to apply to all of its images. The arguments have the meaning
+    of the pipeline call arguments of the same name, except that every editing prompt is used.
+    """
+
+    state: LEditsPPInversionState
+    editing_prompt: Union[str, List[str]]
+    reverse_editing_direction: Union[bool, List[bool]] = False
+    edit_guidance_scale: Union[float, List[float]] = 5
+    edit_warmup_steps: Union[int, List[int]] = 0
+    edit_cooldown_steps: Optional[Union[int, List[int]]] = None
+    edit_threshold: Union[float, List[float]] = 0.9
+    negative_prompt: Optional[str] = None
+    user_mask: Optional[torch.Tensor] = None
+    frequency_scaling: bool = False
+    scale_low: float = 1.0
+    scale_high: float = 1.5
+    freq_cutoff: int = 20
+
+
 class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL):
+    # float32 copy of the VAE for decoding, see `enable_fp32_vae_decoder`
+    _fp32_vae_decoder = None
+
     @torch.no_grad()
     def __call__(
         self,
@@ -127,6 +546,9 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
         scale_low: Optional[float] = 1.0,
         scale_high: Optional[float] = 1.5,
         freq_cutoff: Optional[int] = 20,
+        threshold_bins: Optional[int] = None,
+        record_guidance: Optional[str] = "full",
+        selective_attn_store: bool = True,
         **kwargs,
     ):
         r"""
@@ -209,13 +631,19 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
                 Number of diffusion steps (for each prompt) for which guidance is not applied.
             edit_cooldown_steps (`float` or `List[float]`, *optional*, defaults to `None`):
                 Number of diffusion steps (for each prompt) after which guidance is no longer applied.
+                Concepts outside of their warmup/cooldown window are not run through the UNet, unless
+                `use_cross_attn_mask` or `guidance_rescale` is set.
             edit_threshold (`float` or `List[float]`, *optional*, defaults to 0.9):
                 Masking threshold of guidance. Threshold should be proportional to the image region that is modified.
                 'edit_threshold' is defined as 'λ' of equation 12 of [LEDITS++
                 Paper](https://arxiv.org/abs/2301.12247).
             sem_guidance (`List[torch.Tensor]`, *optional*):
-                List of pre-generated guidance vectors to be applied at generation. Length of the list has to
-                correspond to `num_inference_steps`.
+                List of pre-generated guidance vectors to be applied at generation, e.g. `self.sem_guidance` of an
+                earlier call. Steps covered by the list only run the UNet on the unconditional branch and add the
+                recorded guidance instead of computing the edit-concept branches, so re-rendering a recorded edit
+                costs about 1/(1+K) of the UNet work for K concepts. The vectors may be kept on the host (ideally
+                pinned) and in half precision, they are copied one step ahead. `guidance_rescale` is not applied on
+                these steps.
             use_cross_attn_mask:
                 Whether cross-attention masks are used. Cross-attention masks are always used when use_intersect_mask
                 is set to true. Cross-attention masks are defined as 'M^1' of equation 12 of [LEDITS++
@@ -244,6 +672,22 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
                 The list of tensor inputs for the `callback_on_step_end` function. The tensors specified in the list
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
+            threshold_bins (`int`, *optional*):
+                If set, the masking thresholds (`edit_threshold` quantiles) are approximated from histograms with this
+                many bins instead of being selected exactly. The approximate threshold never exceeds the exact one and
+                is at most 1/`threshold_bins` of the value range lower, so masks can only grow by values within that
+                margin.
+            record_guidance (`str`, *optional*, defaults to `"full"`):
+                How the semantic guidance and activation masks of the edit are recorded, see `LEditsGuidanceRecorder`.
+                `"full"` stores both in float32 as `self.sem_guidance` and `self.activation_mask`. `"compact"` stores
+                the guidance in float16 and the masks bit-packed, `self.activation_mask` is then `None` and the masks
+                are unpacked with `self.guidance_record.unpack_masks()`. `None` records nothing. The copies are
+                non-blocking on CUDA.
+            selective_attn_store (`bool`, *optional*, defaults to `True`):
+                Whether cross-attention masks are computed from a `LEditsCrossAttnCapture`, which hooks only the
+                cross-attention layers at the mask resolution and accumulates the maps of the editing tokens in place,
+                instead of storing the maps of all layers in a `LeditsAttentionStore`. The store is still used if
+                `attn_store_steps` is set.
 
         Examples:
 
@@ -267,6 +711,9 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
         if use_intersect_mask:
             use_cross_attn_mask = True
 
+        if record_guidance not in (None, "full", "compact"):
+            raise ValueError(f"Unknown `record_guidance`: {record_guidance}, expected `None`, 'full' or 'compact'.")
+
         if use_cross_attn_mask:
             self.smoothing = LeditsGaussianSmoothing(self.device)
 
@@ -334,16 +781,23 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
         timesteps = self.inversion_steps
         t_to_idx = {int(v): k for k, v in enumerate(timesteps)}
 
+        attn_capture = None
         if use_cross_attn_mask:
-            self.attention_store = LeditsAttentionStore(
-                average=store_averaged_over_steps,
-                batch_size=batch_size,
-                max_size=(latents.shape[-2] / 4.0) * (latents.shape[-1] / 4.0),
-                max_resolution=None,
-            )
-            self.prepare_unet(self.attention_store)
             resolution = latents.shape[-2:]
             att_res = (int(resolution[0] / 4), int(resolution[1] / 4))
+            if selective_attn_store and not attn_store_steps:
+                attn_capture = LEditsCrossAttnCapture(
+                    num_edit_tokens, prompt_embeds.shape[1], batch_size, att_res, device=device
+                )
+                original_attn_processors = self._prepare_attn_capture(attn_capture, resolution, att_res)
+            else:
+                self.attention_store = LeditsAttentionStore(
+                    average=store_averaged_over_steps,
+                    batch_size=batch_size,
+                    max_size=(latents.shape[-2] / 4.0) * (latents.shape[-1] / 4.0),
+                    max_resolution=None,
+                )
+                self.prepare_unet(self.attention_store)
 
         # 5. Prepare latent variables
         latents = self.prepare_latents(device=device, latents=latents)
@@ -387,6 +841,8 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
         # 8. Denoising loop
         self.sem_guidance = None
         self.activation_mask = None
+        self.guidance_record = None
+        recorder = None
 
         if (
             self.denoising_end is not None
@@ -412,273 +868,205 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
             ).to(device=device, dtype=latents.dtype)
 
         self._num_timesteps = len(timesteps)
-        with self.progress_bar(total=self._num_timesteps) as progress_bar:
-            for i, t in enumerate(timesteps):
-
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * (1 + self.enabled_editing_prompts))
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-                # predict the noise residual
-                added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
-                if ip_adapter_image is not None:
-                    added_cond_kwargs["image_embeds"] = image_embeds
-                noise_pred = self.unet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=prompt_embeds,
-                    cross_attention_kwargs=cross_attention_kwargs,
-                    added_cond_kwargs=added_cond_kwargs,
-                    return_dict=False,
-                )[0]
-
-                noise_pred_out = noise_pred.chunk(1 + self.enabled_editing_prompts)  # [b,4, 64, 64]
-                noise_pred_uncond = noise_pred_out[0]
-                noise_pred_edit_concepts = noise_pred_out[1:-1]
-
-                noise_guidance_edit = torch.zeros(
-                    noise_pred_uncond.shape,
-                    device=self.device,
-                    dtype=noise_pred_uncond.dtype,
-                )
-
-                if sem_guidance is not None and len(sem_guidance) > i:
-                    noise_guidance_edit += sem_guidance[i].to(self.device)
-
-                elif enable_edit_guidance:
-                    if self.activation_mask is None:
-                        self.activation_mask = torch.zeros(
-                            (len(timesteps), self.enabled_editing_prompts, *noise_pred_edit_concepts[0].shape)
-                        )
-                    if self.sem_guidance is None:
-                        self.sem_guidance = torch.zeros((len(timesteps), *noise_pred_uncond.shape))
-
-                    # noise_guidance_edit = torch.zeros_like(noise_guidance)
-                    for c, noise_pred_edit_concept in enumerate(noise_pred_edit_concepts):
-
-                        if isinstance(edit_warmup_steps, list):
-                            edit_warmup_steps_c = edit_warmup_steps[c]
-                        else:
-                            edit_warmup_steps_c = edit_warmup_steps
-                        if i < edit_warmup_steps_c:
-                            continue
-
-                        if isinstance(edit_guidance_scale, list):
-                            edit_guidance_scale_c = edit_guidance_scale[c]
-                        else:
-                            edit_guidance_scale_c = edit_guidance_scale
-
-                        if isinstance(edit_threshold, list):
-                            edit_threshold_c = edit_threshold[c]
-                        else:
-                            edit_threshold_c = edit_threshold
-                        if isinstance(reverse_editing_direction, list):
-                            reverse_editing_direction_c = reverse_editing_direction[c]
-                        else:
-                            reverse_editing_direction_c = reverse_editing_direction
-
-                        if isinstance(edit_cooldown_steps, list):
-                            edit_cooldown_steps_c = edit_cooldown_steps[c]
-                        elif edit_cooldown_steps is None:
-                            edit_cooldown_steps_c = i + 1
+        zs_iter = self._prefetch_steps(
+            zs, [t_to_idx[int(t)] for t in timesteps], device=latents.device, dtype=latents.dtype
+        )
+        # steps covered by recorded guidance only run the unconditional branch of the UNet
+        n_replay_steps = 0 if sem_guidance is None else min(len(sem_guidance), len(timesteps))
+        sem_guidance_iter = self._prefetch_steps(
+            sem_guidance, list(range(n_replay_steps)), device=latents.device, dtype=self.unet.dtype
+        )
+        # concepts outside their warmup/cooldown window are left out of the UNet batch, unless the attention store
+        # or guidance rescale need every concept
+        prune_concepts = enable_edit_guidance and not use_cross_attn_mask and not self.guidance_rescale > 0.0
+        # the branch of the last editing prompt is never used, see `noise_pred_out[1:-1]` below
+        n_concepts = max(self.enabled_editing_prompts - 1, 0)
+        # per-concept guidance parameters, resolved once
+        concept_scales, concept_thresholds = self._concept_params(
+            n_concepts, edit_guidance_scale, edit_threshold, reverse_editing_direction, device=device
+        )
+        try:
+            with self.progress_bar(total=self._num_timesteps) as progress_bar:
+                for i, t in enumerate(timesteps):
+                    replay_step = i < n_replay_steps
+
+                    if replay_step:
+                        # only the unconditional rows come first in the embeddings
+                        n_uncond = batch_size * num_images_per_prompt
+                        latent_model_input = self.scheduler.scale_model_input(latents, t)
+                        encoder_hidden_states = prompt_embeds[:n_uncond]
+                        added_cond_kwargs = {"text_embeds": add_text_embeds[:n_uncond], "time_ids": add_time_ids[:n_uncond]}
+                    elif prune_concepts:
+                        # unconditional branch and the concepts active at this step
+                        active_concepts = self._active_concepts(i, n_concepts, edit_warmup_steps, edit_cooldown_steps)
+                        rows = torch.tensor([0] + [1 + c for c in active_concepts], device=prompt_embeds.device)
+                        latent_model_input = torch.cat([latents] * len(rows))
+                        latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+                        encoder_hidden_states = prompt_embeds[rows]
+                        added_cond_kwargs = {"text_embeds": add_text_embeds[rows], "time_ids": add_time_ids[rows]}
+                    else:
+                        # expand the latents if we are doing classifier free guidance
+                        latent_model_input = torch.cat([latents] * (1 + self.enabled_editing_prompts))
+                        latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+                        encoder_hidden_states = prompt_embeds
+                        added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
+                    # predict the noise residual
+                    if ip_adapter_image is not None:
+                        added_cond_kwargs["image_embeds"] = image_embeds
+                    noise_pred = self.unet(
+                        latent_model_input,
+                        t,
+                        encoder_hidden_states=encoder_hidden_states,
+                        cross_attention_kwargs=cross_attention_kwargs,
+                        added_cond_kwargs=added_cond_kwargs,
+                        return_dict=False,
+                    )[0]
+
+                    if replay_step:
+                        # recorded guidance replaces the edit-concept branches
+                        noise_pred_uncond = noise_pred
+                        noise_guidance_edit = next(sem_guidance_iter)
+                    else:
+                        if prune_concepts:
+                            noise_pred_out = noise_pred.chunk(1 + len(active_concepts))
+                            # inactive concepts are skipped by the concept loop before their prediction is used
+                            noise_pred_edit_concepts = [None] * n_concepts
+                            for c, noise_pred_edit_concept in zip(active_concepts, noise_pred_out[1:]):
+                                noise_pred_edit_concepts[c] = noise_pred_edit_concept
                         else:
-                            edit_cooldown_steps_c = edit_cooldown_steps
-
-                        if i >= edit_cooldown_steps_c:
-                            continue
-
-                        noise_guidance_edit_tmp = noise_pred_edit_concept - noise_pred_uncond 
-
-                        if frequency_scaling:
-                            noise_guidance_edit_tmp = Fourier_filter(noise_guidance_edit_tmp, scale_high=scale_high, scale_low=scale_low, freq_cutoff=freq_cutoff)
-
-                        if reverse_editing_direction_c:
-                            noise_guidance_edit_tmp = noise_guidance_edit_tmp * -1
-
-                        noise_guidance_edit_tmp = noise_guidance_edit_tmp * edit_guidance_scale_c
+                            noise_pred_out = noise_pred.chunk(1 + self.enabled_editing_prompts)  # [b,4, 64, 64]
+                            noise_pred_edit_concepts = noise_pred_out[1:-1]
+                        noise_pred_uncond = noise_pred_out[0]
+
+                        noise_guidance_edit = torch.zeros(
+                            noise_pred_uncond.shape,
+                            device=self.device,
+                            dtype=noise_pred_uncond.dtype,
+                        )
 
-                        if user_mask is not None:
-                            noise_guidance_edit_tmp = noise_guidance_edit_tmp * user_mask
+                    if enable_edit_guidance and not replay_step and record_guidance is not None and recorder is None:
+                        recorder = LEditsGuidanceRecorder(
+                            record_guidance,
+                            len(timesteps),
+                            self.enabled_editing_prompts,
+                            noise_pred_uncond.shape,
+                            device=noise_pred_uncond.device,
+                        )
 
-                        if use_cross_attn_mask:
-                            out = self.attention_store.aggregate_attention(
-                                attention_maps=self.attention_store.step_store,
-                                prompts=self.text_cross_attention_maps,
-                                res=att_res,
-                                from_where=["up", "down"],
-                                is_cross=True,
-                                select=self.text_cross_attention_maps.index(editing_prompt[c]),
+                    if enable_edit_guidance and not replay_step and not use_cross_attn_mask:
+                        # all active concepts at once
+                        if not prune_concepts:
+                            active_concepts = self._active_concepts(i, n_concepts, edit_warmup_steps, edit_cooldown_steps)
+                        if len(active_concepts) > 0:
+                            noise_guidance_edit, concept_masks = self._edit_guidance(
+                                noise_pred_uncond,
+                                torch.stack([noise_pred_edit_concepts[c] for c in active_concepts]),
+                                concept_scales[active_concepts],
+                                [concept_thresholds[c] for c in active_concepts],
+                                user_mask=user_mask,
+                                frequency_scaling=frequency_scaling,
+                                scale_low=scale_low,
+                                scale_high=scale_high,
+                                freq_cutoff=freq_cutoff,
+                                threshold_bins=threshold_bins,
                             )
-                            attn_map = out[:, :, :, 1 : 1 + num_edit_tokens[c]]  # 0 -> startoftext
-
-                            # average over all tokens
-                            if attn_map.shape[3] != num_edit_tokens[c]:
-                                raise ValueError(
-                                    f"Incorrect shape of attention_map. Expected size {num_edit_tokens[c]}, but found {attn_map.shape[3]}!"
-                                )
-                            attn_map = torch.sum(attn_map, dim=3)
-
-                            # gaussian_smoothing
-                            attn_map = F.pad(attn_map.unsqueeze(1), (1, 1, 1, 1), mode="reflect")
-                            attn_map = self.smoothing(attn_map).squeeze(1)
-
-                            # torch.quantile function expects float32
-                            if attn_map.dtype == torch.float32:
-                                tmp = torch.quantile(attn_map.flatten(start_dim=1), edit_threshold_c, dim=1)
+                            if recorder is not None:
+                                recorder.record_masks(i, active_concepts, concept_masks)
+                        if recorder is not None:
+                            recorder.record_guidance(i, noise_guidance_edit)
+
+                    elif enable_edit_guidance and not replay_step:
+                        # all active concepts at once, masked by their cross-attention maps
+                        active_concepts = self._active_concepts(i, n_concepts, edit_warmup_steps, edit_cooldown_steps)
+                        if len(active_concepts) > 0:
+                            if attn_capture is not None:
+                                # maps of all concepts, aggregated once per step
+                                attn_maps = attn_capture.aggregate()[active_concepts]
                             else:
-                                tmp = torch.quantile(
-                                    attn_map.flatten(start_dim=1).to(torch.float32), edit_threshold_c, dim=1
-                                ).to(attn_map.dtype)
-                            attn_mask = torch.where(
-                                attn_map >= tmp.unsqueeze(1).unsqueeze(1).repeat(1, *att_res), 1.0, 0.0
-                            )
-
-                            # resolution must match latent space dimension
-                            attn_mask = F.interpolate(
-                                attn_mask.unsqueeze(1),
-                                noise_guidance_edit_tmp.shape[-2:],  # 64,64
-                            ).repeat(1, 4, 1, 1)
-                            self.activation_mask[i, c] = attn_mask.detach().cpu()
-                            if not use_intersect_mask:
-                                noise_guidance_edit_tmp = noise_guidance_edit_tmp * attn_mask
-
-                        if use_intersect_mask:
-                            noise_guidance_edit_tmp_quantile = torch.abs(noise_guidance_edit_tmp)
-                            noise_guidance_edit_tmp_quantile = torch.sum(
-                                noise_guidance_edit_tmp_quantile, dim=1, keepdim=True
-                            )
-                            noise_guidance_edit_tmp_quantile = noise_guidance_edit_tmp_quantile.repeat(
-                                1, self.unet.config.in_channels, 1, 1
-                            )
-
-                            # torch.quantile function expects float32
-                            if noise_guidance_edit_tmp_quantile.dtype == torch.float32:
-                                tmp = torch.quantile(
-                                    noise_guidance_edit_tmp_quantile.flatten(start_dim=2),
-                                    edit_threshold_c,
-                                    dim=2,
-                                    keepdim=False,
-                                )
-                            else:
-                                tmp = torch.quantile(
-                                    noise_guidance_edit_tmp_quantile.flatten(start_dim=2).to(torch.float32),
-                                    edit_threshold_c,
-                                    dim=2,
-                                    keepdim=False,
-                                ).to(noise_guidance_edit_tmp_quantile.dtype)
-
-                            intersect_mask = (
-                                torch.where(
-                                    noise_guidance_edit_tmp_quantile >= tmp[:, :, None, None],
-                                    torch.ones_like(noise_guidance_edit_tmp),
-                                    torch.zeros_like(noise_guidance_edit_tmp),
+                                attn_maps = torch.stack(
+                                    [
+                                        self._stored_attn_map(editing_prompt[c], num_edit_tokens[c], att_res)
+                                        for c in active_concepts
+                                    ]
                                 )
-                                * attn_mask
+                            noise_guidance_edit, concept_masks = self._edit_guidance(
+                                noise_pred_uncond,
+                                torch.stack([noise_pred_edit_concepts[c] for c in active_concepts]),
+                                concept_scales[active_concepts],
+                                [concept_thresholds[c] for c in active_concepts],
+                                user_mask=user_mask,
+                                frequency_scaling=frequency_scaling,
+                                scale_low=scale_low,
+                                scale_high=scale_high,
+                                freq_cutoff=freq_cutoff,
+                                threshold_bins=threshold_bins,
+                                attn_maps=attn_maps.to(noise_pred_uncond.dtype),
+                                intersect=use_intersect_mask,
                             )
+                            if recorder is not None:
+                                recorder.record_masks(i, active_concepts, concept_masks)
+                        if recorder is not None:
+                            recorder.record_guidance(i, noise_guidance_edit)
+
+                    noise_pred = noise_pred_uncond + noise_guidance_edit
+
+                    # compute the previous noisy sample x_t -> x_t-1
+                    if enable_edit_guidance and self.guidance_rescale > 0.0 and not replay_step:
+                        # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
+                        noise_pred = rescale_noise_cfg(
+                            noise_pred,
+                            noise_pred_edit_concepts.mean(dim=0, keepdim=False),
+                            guidance_rescale=self.guidance_rescale,
+                        )
 
-                            self.activation_mask[i, c] = intersect_mask.detach().cpu()
+                    latents = self.scheduler.step(
+                        noise_pred, t, latents, variance_noise=next(zs_iter), **extra_step_kwargs, return_dict=False
+                    )[0]
+
+                    # step callback
+                    if attn_capture is not None:
+                        attn_capture.reset()
+                    elif use_cross_attn_mask and replay_step:
+                        # maps of the unconditional branch only, nothing to aggregate
+                        self.attention_store.step_store = self.attention_store.get_empty_store()
+                    elif use_cross_attn_mask:
+                        store_step = i in attn_store_steps
+                        self.attention_store.between_steps(store_step)
+
+                    if callback_on_step_end is not None:
+                        callback_kwargs = {}
+                        for k in callback_on_step_end_tensor_inputs:
+                            callback_kwargs[k] = locals()[k]
+                        callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
+
+                        latents = callback_outputs.pop("latents", latents)
+                        prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
+                        negative_prompt_embeds = callback_outputs.pop("negative_prompt_embeds", negative_prompt_embeds)
+                        add_text_embeds = callback_outputs.pop("add_text_embeds", add_text_embeds)
+                        negative_pooled_prompt_embeds = callback_outputs.pop(
+                            "negative_pooled_prompt_embeds", negative_pooled_prompt_embeds
+                        )
+                        add_time_ids = callback_outputs.pop("add_time_ids", add_time_ids)
+                        # negative_add_time_ids = callback_outputs.pop("negative_add_time_ids", negative_add_time_ids)
 
-                            noise_guidance_edit_tmp = noise_guidance_edit_tmp * intersect_mask
+                    # call the callback, if provided
+                    if i == len(timesteps) - 1 or ((i + 1) > 0 and (i + 1) % self.scheduler.order == 0):
+                        progress_bar.update()
 
-                        elif not use_cross_attn_mask:
-                            # calculate quantile
-                            noise_guidance_edit_tmp_quantile = torch.abs(noise_guidance_edit_tmp)
-                            noise_guidance_edit_tmp_quantile = torch.sum(
-                                noise_guidance_edit_tmp_quantile, dim=1, keepdim=True
-                            )
-                            noise_guidance_edit_tmp_quantile = noise_guidance_edit_tmp_quantile.repeat(1, 4, 1, 1)
-
-                            # torch.quantile function expects float32
-                            if noise_guidance_edit_tmp_quantile.dtype == torch.float32:
-                                tmp = torch.quantile(
-                                    noise_guidance_edit_tmp_quantile.flatten(start_dim=2),
-                                    edit_threshold_c,
-                                    dim=2,
-                                    keepdim=False,
-                                )
-                            else:
-                                tmp = torch.quantile(
-                                    noise_guidance_edit_tmp_quantile.flatten(start_dim=2).to(torch.float32),
-                                    edit_threshold_c,
-                                    dim=2,
-                                    keepdim=False,
-                                ).to(noise_guidance_edit_tmp_quantile.dtype)
-
-                            self.activation_mask[i, c] = (
-                                torch.where(
-                                    noise_guidance_edit_tmp_quantile >= tmp[:, :, None, None],
-                                    torch.ones_like(noise_guidance_edit_tmp),
-                                    torch.zeros_like(noise_guidance_edit_tmp),
-                                )
-                                .detach()
-                                .cpu()
-                            )
-                            noise_guidance_edit_tmp = torch.where(
-                                noise_guidance_edit_tmp_quantile >= tmp[:, :, None, None],
-                                noise_guidance_edit_tmp,
-                                torch.zeros_like(noise_guidance_edit_tmp),
-                            )
+                    if XLA_AVAILABLE:
+                        xm.mark_step()
+        finally:
+            if attn_capture is not None:
+                self.unet.set_attn_processor(original_attn_processors)
 
-                        noise_guidance_edit += noise_guidance_edit_tmp
-
-                    self.sem_guidance[i] = noise_guidance_edit.detach().cpu()
-
-                noise_pred = noise_pred_uncond + noise_guidance_edit
-
-                # compute the previous noisy sample x_t -> x_t-1
-                if enable_edit_guidance and self.guidance_rescale > 0.0:
-                    # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
-                    noise_pred = rescale_noise_cfg(
-                        noise_pred,
-                        noise_pred_edit_concepts.mean(dim=0, keepdim=False),
-                        guidance_rescale=self.guidance_rescale,
-                    )
-
-                idx = t_to_idx[int(t)]
-                latents = self.scheduler.step(
-                    noise_pred, t, latents, variance_noise=zs[idx], **extra_step_kwargs, return_dict=False
-                )[0]
-
-                # step callback
-                if use_cross_attn_mask:
-                    store_step = i in attn_store_steps
-                    self.attention_store.between_steps(store_step)
-
-                if callback_on_step_end is not None:
-                    callback_kwargs = {}
-                    for k in callback_on_step_end_tensor_inputs:
-                        callback_kwargs[k] = locals()[k]
-                    callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
-
-                    latents = callback_outputs.pop("latents", latents)
-                    prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
-                    negative_prompt_embeds = callback_outputs.pop("negative_prompt_embeds", negative_prompt_embeds)
-                    add_text_embeds = callback_outputs.pop("add_text_embeds", add_text_embeds)
-                    negative_pooled_prompt_embeds = callback_outputs.pop(
-                        "negative_pooled_prompt_embeds", negative_pooled_prompt_embeds
-                    )
-                    add_time_ids = callback_outputs.pop("add_time_ids", add_time_ids)
-                    # negative_add_time_ids = callback_outputs.pop("negative_add_time_ids", negative_add_time_ids)
-
-                # call the callback, if provided
-                if i == len(timesteps) - 1 or ((i + 1) > 0 and (i + 1) % self.scheduler.order == 0):
-                    progress_bar.update()
-
-                if XLA_AVAILABLE:
-                    xm.mark_step()
+        if recorder is not None:
+            recorder.finalize()
+            self.guidance_record = recorder
+            self.sem_guidance = recorder.sem_guidance
+            self.activation_mask = recorder.masks if record_guidance == "full" else None
 
         if not output_type == "latent":
-            # make sure the VAE is in float32 mode, as it overflows in float16
-            needs_upcasting = self.vae.dtype == torch.float16 and self.vae.config.force_upcast
-
-            if needs_upcasting:
-                self.upcast_vae()
-                latents = latents.to(next(iter(self.vae.post_quant_conv.parameters())).dtype)
-
-            image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False)[0]
-
-            # cast back to fp16 if needed
-            if needs_upcasting:
-                self.vae.to(dtype=torch.float16)
+            image = self._decode_latents(latents)
         else:
             image = latents
 
@@ -715,6 +1103,10 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
         width: Optional[int] = None,
         resize_mode: Optional[str] = "default",
         crops_coords: Optional[Tuple[int, int, int, int]] = None,
+        inversion_cache: Optional[LEditsInversionCache] = None,
+        streaming_inversion: bool = False,
+        zs_offload: Optional[str] = None,
+        vae_reconstruction: bool = True,
     ):
         r"""
         The function to the pipeline for image inversion as described by the [LEDITS++
@@ -757,6 +1149,20 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
                 A kwargs dictionary that if specified is passed along to the `AttentionProcessor` as defined under
                 `self.processor` in
                 [diffusers.models.attention_processor](https://github.com/huggingface/diffusers/blob/main/src/diffusers/models/attention_processor.py).
+            inversion_cache (`LEditsInversionCache`, *optional*):
+                On-disk cache to look the inversion up in before running any model, and to store it in otherwise. The
+                current state of `generator` is part of the key, so a generator that has already drawn noise does not
+                hit entries stored with a fresh one. `inverision_latents` is not restored on a hit.
+            streaming_inversion (`bool`, defaults to `False`):
+                Keep the noised intermediate latents in host memory and only the current pair on the device, and do
+                not retain `inverision_latents`. Only `zs` and `init_latents`, which the edit loop needs, are kept.
+            zs_offload (`str`, *optional*):
+                Where to keep `zs` between inversion and edits: `None` on the device, `"pinned"` in pinned host memory
+                or `"mmap"` in a memory-mapped temporary file. Offloaded noise maps are prefetched step by step
+                during editing.
+            vae_reconstruction (`bool`, defaults to `True`):
+                Whether to decode the encoded image(s) back through the VAE for `vae_reconstruction_images`. Without
+                it, `vae_reconstruction_images` is `None` and the decode is skipped.
 
         Returns:
             [`~pipelines.ledits_pp.LEditsPPInversionPipelineOutput`]: Output will contain the resized input image(s)
@@ -779,6 +1185,51 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
 
         device = self._execution_device
 
+        if inversion_cache is not None:
+            cache_key = inversion_cache.make_key(
+                image,
+                model=self.config.get("_name_or_path"),
+                dtype=self.text_encoder_2.dtype,
+                scheduler=type(self.scheduler).__name__,
+                scheduler_config=dict(self.scheduler.config),
+                source_prompt=source_prompt,
+                source_guidance_scale=source_guidance_scale,
+                negative_prompt=negative_prompt,
+                negative_prompt_2=negative_prompt_2,
+                num_inversion_steps=num_inversion_steps,
+                skip=skip,
+                generator_state=(
+                    None if generator is None else hashlib.sha256(generator.get_state().numpy().tobytes()).hexdigest()
+                ),
+                crops_coords_top_left=crops_coords_top_left,
+                num_zero_noise_steps=num_zero_noise_steps,
+                cross_attention_kwargs=cross_attention_kwargs,
+                height=height,
+                width=width,
+                resize_mode=resize_mode,
+                crops_coords=crops_coords,
+            )
+            cached = inversion_cache.get(cache_key)
+            if cached is not None and vae_reconstruction and cached["vae_reconstruction_images"] is None:
+                # stored without reconstructions, invert again
+                cached = None
+            if cached is not None:
+                dtype = getattr(torch, cached["meta"]["dtype"])
+                self.size = tuple(cached["meta"]["size"])
+                self.batch_size = cached["meta"]["batch_size"]
+                self.inversion_steps = cached["inversion_steps"].to(timesteps.device)
+                self.init_latents = cached["init_latents"].to(device=self.device, dtype=dtype)
+                if zs_offload == "mmap":
+                    self.zs = cached["zs"]
+                else:
+                    self.zs = self._allocate_zs(cached["zs"].shape, dtype, zs_offload).copy_(cached["zs"])
+                self.inverision_latents = None
+                self.scheduler.set_timesteps(len(self.scheduler.timesteps))
+                return LEditsPPInversionPipelineOutput(
+                    images=cached["images"],
+                    vae_reconstruction_images=cached["vae_reconstruction_images"] if vae_reconstruction else None,
+                )
+
         # 0. Ensure that only uncond embedding is used if prompt = ""
         if source_prompt == "":
             # noise pred should only be noise_pred_uncond
@@ -851,46 +1302,47 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
         add_time_ids = add_time_ids.to(device).repeat(self.batch_size * num_images_per_prompt, 1)
 
         # autoencoder reconstruction
-        if self.vae.dtype == torch.float16 and self.vae.config.force_upcast:
-            self.upcast_vae()
-            x0_tmp = x0.to(next(iter(self.vae.post_quant_conv.parameters())).dtype)
-            image_rec = self.vae.decode(
-                x0_tmp / self.vae.config.scaling_factor, return_dict=False, generator=generator
-            )[0]
-        elif self.vae.config.force_upcast:
-            x0_tmp = x0.to(next(iter(self.vae.post_quant_conv.parameters())).dtype)
-            image_rec = self.vae.decode(
-                x0_tmp / self.vae.config.scaling_factor, return_dict=False, generator=generator
-            )[0]
+        if vae_reconstruction:
+            image_rec = self._decode_latents(x0, generator=generator)
+            image_rec = self.image_processor.postprocess(image_rec, output_type="pil")
         else:
-            image_rec = self.vae.decode(x0 / self.vae.config.scaling_factor, return_dict=False, generator=generator)[0]
-
-        image_rec = self.image_processor.postprocess(image_rec, output_type="pil")
+            image_rec = None
 
         # 5. find zs and xts
         variance_noise_shape = (num_inversion_steps, *x0.shape)
 
         # intermediate latents
         t_to_idx = {int(v): k for k, v in enumerate(timesteps)}
-        xts = torch.zeros(size=variance_noise_shape, device=self.device, dtype=negative_prompt_embeds.dtype)
+        if streaming_inversion:
+            # noised latents wait in host memory, only the current pair is on the device
+            xts = torch.zeros(
+                size=variance_noise_shape,
+                dtype=negative_prompt_embeds.dtype,
+                pin_memory=self.device.type == "cuda",
+            )
+        else:
+            xts = torch.zeros(size=variance_noise_shape, device=self.device, dtype=negative_prompt_embeds.dtype)
 
         for t in reversed(timesteps):
             idx = num_inversion_steps - t_to_idx[int(t)] - 1
             noise = randn_tensor(shape=x0.shape, generator=generator, device=self.device, dtype=x0.dtype)
-            xts[idx] = self.scheduler.add_noise(x0, noise, t.unsqueeze(0))
-        xts = torch.cat([x0.unsqueeze(0), xts], dim=0)
-        xts_new = torch.cat([x0.unsqueeze(0), xts], dim=0)
+            xts[idx].copy_(self.scheduler.add_noise(x0, noise, t.unsqueeze(0)))
+        if not streaming_inversion:
+            xts = torch.cat([x0.unsqueeze(0), xts], dim=0)
 
-        # noise maps
-        zs = torch.zeros(size=variance_noise_shape, device=self.device, dtype=negative_prompt_embeds.dtype)
-        zs_new = torch.zeros(size=variance_noise_shape, device=self.device, dtype=negative_prompt_embeds.dtype)
+        # noise maps, in the order of the edit loop
+        zs = self._allocate_zs(variance_noise_shape, negative_prompt_embeds.dtype, zs_offload)
 
         self.scheduler.set_timesteps(len(self.scheduler.timesteps))
 
+        xt = None
         for t in self.progress_bar(timesteps):
             idx = num_inversion_steps - t_to_idx[int(t)] - 1
             # 1. predict noise residual
-            xt = xts[idx + 1]
+            if not streaming_inversion:
+                xt = xts[idx + 1]
+            elif xt is None:
+                xt = xts[idx].to(self.device)
 
             latent_model_input = torch.cat([xt] * 2) if do_classifier_free_guidance else xt
             latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
@@ -912,23 +1364,685 @@ class LEditsPPPipelineStableDiffusionXLScaling(LEditsPPPipelineStableDiffusionXL
                 noise_pred_uncond, noise_pred_text = noise_pred_out[0], noise_pred_out[1]
                 noise_pred = noise_pred_uncond + source_guidance_scale * (noise_pred_text - noise_pred_uncond)
 
-            xtm1 = xts[idx]
+            if not streaming_inversion:
+                xtm1 = xts[idx]
+            elif idx > 0:
+                xtm1 = xts[idx - 1].to(self.device, non_blocking=True)
+            else:
+                xtm1 = x0
             z, xtm1_corrected = compute_noise(self.scheduler, xtm1, xt, t, noise_pred, self.eta)
-            zs[idx] = z
+            zs[num_inversion_steps - idx - 1].copy_(z)
 
             # correction to avoid error accumulation
-            xts[idx] = xtm1_corrected
-
-        self.init_latents = xts[-1]
-        self.inverision_latents = xts
-        zs = zs.flip(0)
+            if streaming_inversion:
+                xt = xtm1_corrected
+            else:
+                xts[idx] = xtm1_corrected
+
+        if streaming_inversion:
+            self.init_latents = xts[-1].to(self.device)
+            self.inverision_latents = None
+        else:
+            self.init_latents = xts[-1]
+            self.inverision_latents = xts
 
         if num_zero_noise_steps > 0:
-            zs[-num_zero_noise_steps:] = torch.zeros_like(zs[-num_zero_noise_steps:])
+            zs[-num_zero_noise_steps:] = 0
         self.zs = zs
 
+        if inversion_cache is not None:
+            inversion_cache.put(
+                cache_key,
+                zs=self.zs,
+                init_latents=self.init_latents,
+                inversion_steps=self.inversion_steps,
+                images=resized,
+                vae_reconstruction_images=image_rec,
+                size=self.size,
+            )
+
         return LEditsPPInversionPipelineOutput(images=resized, vae_reconstruction_images=image_rec)
 
+    def inversion_state(
+        self, inversion_output: Optional[LEditsPPInversionPipelineOutput] = None
+    ) -> LEditsPPInversionState:
+        """
+        Snapshot of the inversion held by the pipeline after `invert`, optionally with the images of its output.
+        """
+        if self.inversion_steps is None:
+            raise ValueError("You need to invert an input image first. The `invert` method has to be called beforehand.")
+        return LEditsPPInversionState(
+            init_latents=self.init_latents,
+            zs=self.zs,
+            inversion_steps=self.inversion_steps,
+            num_scheduler_steps=len(self.scheduler.timesteps),
+            size=self.size,
+            eta=self.eta,
+            images=None if inversion_output is None else inversion_output.images,
+            vae_reconstruction_images=None if inversion_output is None else inversion_output.vae_reconstruction_images,
+        )
+
+    @torch.no_grad()
+    def invert_many(
+        self,
+        images: List[PipelineImageInput],
+        source_prompt: Union[str, List[str]] = "",
+        **kwargs,
+    ) -> List[LEditsPPInversionState]:
+        r"""
+        Invert several independent images. Images of the same size, and either all with or all without a source
+        prompt, are inverted together in one batched `invert` call.
+
+        Args:
+            images (`List[PipelineImageInput]`):
+                The images to invert, one per entry.
+            source_prompt (`str` or `List[str]`, defaults to `""`):
+                Prompt describing each image, see `invert`.
+            kwargs:
+                Further arguments of `invert`, shared by all images.
+
+        Returns:
+            `List[LEditsPPInversionState]`: One state per image, in the order of `images`. The states of a batch are
+            views of its batched tensors.
+        """
+        if isinstance(source_prompt, str):
+            source_prompt = [source_prompt] * len(images)
+        if len(source_prompt) != len(images):
+            raise ValueError(
+                f"`source_prompt` has {len(source_prompt)} entries, but {len(images)} images were passed."
+            )
+
+        groups = {}
+        for k, (image, prompt) in enumerate(zip(images, source_prompt)):
+            size = image.size if isinstance(image, PIL.Image.Image) else tuple(image.shape[-2:])
+            groups.setdefault((size, prompt == ""), []).append(k)
+
+        states = [None] * len(images)
+        for indices in groups.values():
+            prompts = [source_prompt[k] for k in indices]
+            output = self.invert(
+                image=[images[k] for k in indices],
+                source_prompt=prompts[0] if len(set(prompts)) == 1 else prompts,
+                **kwargs,
+            )
+            state = self.inversion_state(output)
+            image_rec = output.vae_reconstruction_images
+            for b, k in enumerate(indices):
+                states[k] = LEditsPPInversionState(
+                    init_latents=state.init_latents[b : b + 1],
+                    zs=state.zs[:, b : b + 1],
+                    inversion_steps=state.inversion_steps,
+                    num_scheduler_steps=state.num_scheduler_steps,
+                    size=state.size,
+                    eta=state.eta,
+                    images=output.images[b : b + 1],
+                    vae_reconstruction_images=None if image_rec is None else image_rec[b : b + 1],
+                )
+        return states
+
+    @torch.no_grad()
+    def edit_many(
+        self,
+        requests: List[LEditsPPEditRequest],
+        output_type: Optional[str] = "pil",
+        crops_coords_top_left: Tuple[int, int] = (0, 0),
+        cross_attention_kwargs: Optional[Dict[str, Any]] = None,
+        threshold_bins: Optional[int] = None,
+    ) -> List[LEditsPPDiffusionPipelineOutput]:
+        r"""
+        Apply several independent edits. Requests whose inversions share the timesteps, latent shape and eta run their
+        denoising loops in lockstep, with the unconditional and active concept branches of all of them in one UNet
+        batch and one scheduler step. The inversion attributes of the pipeline are neither read nor changed.
+
+        Each request gets the noise-estimate masked guidance of the pipeline call. Cross-attention masks, guidance
+        rescale and recorded guidance are not supported.
+
+        Args:
+            requests (`List[LEditsPPEditRequest]`):
+                The edits, each with its inversion state.
+            output_type (`str`, *optional*, defaults to `"pil"`):
+                The output format of the edited images, see the pipeline call.
+            crops_coords_top_left (`Tuple[int]`, *optional*, defaults to (0, 0)):
+                Micro-conditioning of all requests, see the pipeline call.
+            cross_attention_kwargs (`dict`, *optional*):
+                Passed to the attention processors, see the pipeline call.
+            threshold_bins (`int`, *optional*):
+                Approximate the masking thresholds from histograms, see the pipeline call.
+
+        Returns:
+            `List[LEditsPPDiffusionPipelineOutput]`: One output per request, in the order of `requests`.
+        """
+        groups = {}
+        for k, request in enumerate(requests):
+            state = request.state
+            key = (
+                tuple(state.inversion_steps.tolist()),
+                state.num_scheduler_steps,
+                tuple(state.init_latents.shape[1:]),
+                state.eta,
+            )
+            groups.setdefault(key, []).append(k)
+
+        outputs = [None] * len(requests)
+        for indices in groups.values():
+            group = [requests[k] for k in indices]
+            latents = self._edit_lockstep(group, crops_coords_top_left, cross_attention_kwargs, threshold_bins)
+
+            if not output_type == "latent":
+                image = self._decode_latents(latents)
+
+                # apply watermark if available
+                if self.watermark is not None:
+                    image = self.watermark.apply_watermark(image)
+
+                image = self.image_processor.postprocess(image, output_type=output_type)
+            else:
+                image = latents
+
+            start = 0
+            for k, request in zip(indices, group):
+                end = start + request.state.batch_size
+                outputs[k] = LEditsPPDiffusionPipelineOutput(images=image[start:end], nsfw_content_detected=None)
+                start = end
+
+        # Offload all models
+        self.maybe_free_model_hooks()
+
+        return outputs
+
+    def _encode_edit_request(
+        self,
+        request: LEditsPPEditRequest,
+        device: torch.device,
+        crops_coords_top_left: Tuple[int, int],
+        cross_attention_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Text embeddings, pooled embeddings and time ids of a request, with the rows ordered as [unconditional,
+        concept 1, ..., concept K] and each block repeated for the images of the request.
+        """
+        batch_size = request.state.batch_size
+        editing_prompt = request.editing_prompt
+        if isinstance(editing_prompt, str):
+            editing_prompt = [editing_prompt]
+        text_encoder_lora_scale = (
+            cross_attention_kwargs.get("scale", None) if cross_attention_kwargs is not None else None
+        )
+
+        # `encode_prompt` sizes the unconditional embeddings by `self.batch_size`
+        previous_batch_size = getattr(self, "batch_size", None)
+        self.batch_size = batch_size
+        try:
+            (
+                negative_prompt_embeds,
+                edit_prompt_embeds,
+                negative_pooled_prompt_embeds,
+                pooled_edit_embeds,
+                _,
+            ) = self.encode_prompt(
+                device=device,
+                num_images_per_prompt=1,
+                negative_prompt=request.negative_prompt,
+                lora_scale=text_encoder_lora_scale,
+                enable_edit_guidance=True,
+                editing_prompt=editing_prompt,
+            )
+        finally:
+            self.batch_size = previous_batch_size
+
+        if self.text_encoder_2 is None:
+            text_encoder_projection_dim = int(negative_pooled_prompt_embeds.shape[-1])
+        else:
+            text_encoder_projection_dim = self.text_encoder_2.config.projection_dim
+
+        prompt_embeds = torch.cat(
+            [negative_prompt_embeds, edit_prompt_embeds.repeat_interleave(batch_size, dim=0)], dim=0
+        )
+        add_text_embeds = torch.cat(
+            [negative_pooled_prompt_embeds, pooled_edit_embeds.repeat_interleave(batch_size, dim=0)], dim=0
+        )
+        add_time_ids = self._get_add_time_ids(
+            request.state.size,
+            crops_coords_top_left,
+            request.state.size,
+            dtype=negative_pooled_prompt_embeds.dtype,
+            text_encoder_projection_dim=text_encoder_projection_dim,
+        ).repeat(prompt_embeds.shape[0], 1)
+        return prompt_embeds.to(device), add_text_embeds.to(device), add_time_ids.to(device)
+
+    def _edit_lockstep(
+        self,
+        requests: List[LEditsPPEditRequest],
+        crops_coords_top_left: Tuple[int, int],
+        cross_attention_kwargs: Optional[Dict[str, Any]],
+        threshold_bins: Optional[int],
+    ) -> torch.Tensor:
+        """
+        Denoising loop of `edit_many` for requests with the same timesteps. Returns the final latents of all requests,
+        concatenated in order.
+        """
+        device = self._execution_device
+        state = requests[0].state
+        self.scheduler.set_timesteps(state.num_scheduler_steps)
+        timesteps = state.inversion_steps
+        t_to_idx = {int(v): k for k, v in enumerate(timesteps)}
+        extra_step_kwargs = self.prepare_extra_step_kwargs(state.eta)
+
+        latents = torch.cat([request.state.init_latents.to(device) for request in requests], dim=0)
+        latents = latents * self.scheduler.init_noise_sigma
+
+        # embeddings of all requests, each block of rows starting at its offset
+        prompt_embeds, add_text_embeds, add_time_ids, row_offsets = [], [], [], []
+        n_concepts, concept_scales, concept_thresholds, user_masks, zs_iters = [], [], [], [], []
+        n_rows = 0
+        for request in requests:
+            embeds, text_embeds, time_ids = self._encode_edit_request(
+                request, device, crops_coords_top_left, cross_attention_kwargs
+            )
+            prompt_embeds.append(embeds)
+            add_text_embeds.append(text_embeds)
+            add_time_ids.append(time_ids)
+            row_offsets.append(n_rows)
+            n_rows += embeds.shape[0]
+
+            n = embeds.shape[0] // request.state.batch_size - 1
+            scales, thresholds = self._concept_params(
+                n,
+                request.edit_guidance_scale,
+                request.edit_threshold,
+                request.reverse_editing_direction,
+                device=device,
+            )
+            n_concepts.append(n)
+            concept_scales.append(scales)
+            concept_thresholds.append(thresholds)
+            user_masks.append(None if request.user_mask is None else request.user_mask.to(device))
+            zs_iters.append(
+                self._prefetch_steps(
+                    request.state.zs, [t_to_idx[int(t)] for t in timesteps], device=latents.device, dtype=latents.dtype
+                )
+            )
+        prompt_embeds = torch.cat(prompt_embeds, dim=0)
+        add_text_embeds = torch.cat(add_text_embeds, dim=0)
+        add_time_ids = torch.cat(add_time_ids, dim=0)
+        batch_sizes = [request.state.batch_size for request in requests]
+        latent_offsets = np.cumsum([0] + batch_sizes[:-1]).tolist()
+
+        self._num_timesteps = len(timesteps)
+        for i, t in enumerate(self.progress_bar(timesteps)):
+            # unconditional branch and the active concepts of every request
+            active_concepts, rows, latent_model_input = [], [], []
+            for r, request in enumerate(requests):
+                b = batch_sizes[r]
+                active = self._active_concepts(i, n_concepts[r], request.edit_warmup_steps, request.edit_cooldown_steps)
+                active_concepts.append(active)
+                for block in [0] + [1 + c for c in active]:
+                    rows.extend(range(row_offsets[r] + block * b, row_offsets[r] + (block + 1) * b))
+                    latent_model_input.append(latents[latent_offsets[r] : latent_offsets[r] + b])
+            rows = torch.tensor(rows, device=prompt_embeds.device)
+            latent_model_input = self.scheduler.scale_model_input(torch.cat(latent_model_input, dim=0), t)
+
+            noise_pred = self.unet(
+                latent_model_input,
+                t,
+                encoder_hidden_states=prompt_embeds[rows],
+                cross_attention_kwargs=cross_attention_kwargs,
+                added_cond_kwargs={"text_embeds": add_text_embeds[rows], "time_ids": add_time_ids[rows]},
+                return_dict=False,
+            )[0]
+
+            guided_noise_preds = []
+            start = 0
+            for r, request in enumerate(requests):
+                b, active = batch_sizes[r], active_concepts[r]
+                noise_pred_request = noise_pred[start : start + (1 + len(active)) * b]
+                start += noise_pred_request.shape[0]
+                noise_pred_uncond = noise_pred_request[:b]
+                if len(active) == 0:
+                    guided_noise_preds.append(noise_pred_uncond)
+                    continue
+                noise_guidance_edit, _ = self._edit_guidance(
+                    noise_pred_uncond,
+                    noise_pred_request[b:].view(len(active), *noise_pred_uncond.shape),
+                    concept_scales[r][active],
+                    [concept_thresholds[r][c] for c in active],
+                    user_mask=user_masks[r],
+                    frequency_scaling=request.frequency_scaling,
+                    scale_low=request.scale_low,
+                    scale_high=request.scale_high,
+                    freq_cutoff=request.freq_cutoff,
+                    threshold_bins=threshold_bins,
+                )
+                guided_noise_preds.append(noise_pred_uncond + noise_guidance_edit)
+            noise_pred = torch.cat(guided_noise_preds, dim=0)
+
+            variance_noise = torch.cat([next(zs_iter) for zs_iter in zs_iters], dim=0)
+            latents = self.scheduler.step(
+                noise_pred, t, latents, variance_noise=variance_noise, **extra_step_kwargs, return_dict=False
+            )[0]
+
+            if XLA_AVAILABLE:
+                xm.mark_step()
+
+        return latents
+
+    @staticmethod
+    def _concept_params(
+        n_concepts: int,
+        edit_guidance_scale: Union[float, List[float]],
+        edit_threshold: Union[float, List[float]],
+        reverse_editing_direction: Union[bool, List[bool]],
+        device: torch.device,
+    ) -> Tuple[torch.Tensor, List[float]]:
+        """
+        Per-concept guidance scales, negated for reversed directions, as a tensor of shape [K], and thresholds.
+        """
+
+        def per_concept(value):
+            return [value[c] if isinstance(value, list) else value for c in range(n_concepts)]
+
+        scales = [
+            -scale if reverse else scale
+            for scale, reverse in zip(per_concept(edit_guidance_scale), per_concept(reverse_editing_direction))
+        ]
+        return torch.tensor(scales, dtype=torch.float32, device=device), per_concept(edit_threshold)
+
+    @staticmethod
+    def _batched_quantile(x: torch.Tensor, q: List[float], bins: Optional[int] = None) -> torch.Tensor:
+        """
+        Quantiles of the last dimension of `x` by selection instead of sorting, with one level per leading index.
+
+        Rows sharing a level are selected together with `kthvalue`, interpolating linearly between the two
+        neighboring ranks as `torch.quantile` does, so the result is exact. With `bins`, the quantile is instead
+        approximated from a per-row histogram by the lower edge of the bin holding the value at the lower
+        neighboring rank. It never exceeds the exact quantile and is at most (max - min) / `bins` below that value,
+        so thresholding keeps a superset of the exact mask.
+
+        Args:
+            x (`torch.Tensor`):
+                Values, with the shape of [K, ..., N].
+            q (`List[float]`):
+                Quantile levels of the K leading indices.
+            bins (`int`, *optional*):
+                Number of histogram bins of the approximation.
+
+        Returns:
+            `torch.Tensor`: Quantiles in float32, with the shape of [K, ...].
+        """
+        n = x.shape[-1]
+        out = torch.empty(x.shape[:-1], dtype=torch.float32, device=x.device)
+        for level in sorted(set(q)):
+            rows = [k for k, qk in enumerate(q) if qk == level]
+            values = x[rows] if len(rows) < len(q) else x
+
+            if bins:
+                values = values.to(torch.float32)
+                lo = values.amin(dim=-1, keepdim=True)
+                width = (values.amax(dim=-1, keepdim=True) - lo).clamp_min(torch.finfo(torch.float32).tiny) / bins
+                idx = ((values - lo) / width).long().clamp_(0, bins - 1)
+                counts = torch.zeros((*values.shape[:-1], bins), dtype=torch.int64, device=x.device)
+                counts.scatter_add_(-1, idx, torch.ones_like(idx))
+                # first bin in which the rank of the quantile falls
+                rank = int(level * (n - 1))
+                bin_idx = (counts.cumsum(dim=-1) <= rank).sum(dim=-1, keepdim=True)
+                quantile = (lo + bin_idx * width).squeeze(-1)
+            else:
+                # ranks in float32 as in torch.quantile
+                rank = torch.tensor(level, dtype=torch.float32) * (n - 1)
+                rank_below, rank_above = int(rank), int(rank.ceil())
+                below = values.kthvalue(rank_below + 1, dim=-1).values.to(torch.float32)
+                if rank_above == rank_below:
+                    quantile = below
+                else:
+                    above = values.kthvalue(rank_above + 1, dim=-1).values.to(torch.float32)
+                    quantile = torch.lerp(below, above, (rank - rank_below).item())
+
+            if len(rows) < len(q):
+                out[rows] = quantile
+            else:
+                out = quantile
+        return out
+
+    def _edit_guidance(
+        self,
+        noise_pred_uncond: torch.Tensor,
+        noise_pred_edit_concepts: torch.Tensor,
+        scales: torch.Tensor,
+        thresholds: List[float],
+        user_mask: Optional[torch.Tensor] = None,
+        frequency_scaling: bool = False,
+        scale_low: float = 1.0,
+        scale_high: float = 1.5,
+        freq_cutoff: int = 20,
+        threshold_bins: Optional[int] = None,
+        attn_maps: Optional[torch.Tensor] = None,
+        intersect: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Thresholded edit guidance of K concepts at once, masked by the noise estimate or by cross-attention maps.
+
+        Args:
+            noise_pred_uncond (`torch.Tensor`):
+                Unconditional noise prediction, with the shape of [B, C, H, W].
+            noise_pred_edit_concepts (`torch.Tensor`):
+                Noise predictions of the concepts, with the shape of [K, B, C, H, W].
+            scales (`torch.Tensor`):
+                Signed guidance scales of the concepts, with the shape of [K].
+            thresholds (`List[float]`):
+                Masking thresholds of the concepts.
+            threshold_bins (`int`, *optional*):
+                Approximate the thresholds from histograms, see `_batched_quantile`.
+            attn_maps (`torch.Tensor`, *optional*):
+                Cross-attention maps of the concepts, with the shape of [K, B, h, w]. If given, the smoothed maps are
+                thresholded instead of the noise estimate.
+            intersect (`bool`, *optional*, defaults to `False`):
+                Intersect the cross-attention masks with the noise-estimate masks.
+
+        Returns:
+            `Tuple[torch.Tensor, torch.Tensor]`: The guidance summed over the concepts, with the shape of [B, C, H, W],
+            and the activation masks of the concepts, with the shape of [K, B, C, H, W].
+        """
+        K, B, C, H, W = noise_pred_edit_concepts.shape
+        guidance = noise_pred_edit_concepts - noise_pred_uncond
+        if frequency_scaling:
+            guidance = Fourier_filter(
+                guidance.reshape(K * B, C, H, W), scale_high=scale_high, scale_low=scale_low, freq_cutoff=freq_cutoff
+            ).reshape(K, B, C, H, W)
+        guidance = guidance * scales.to(guidance.dtype)[:, None, None, None, None]
+        if user_mask is not None:
+            guidance = guidance * user_mask
+
+        if attn_maps is not None:
+            # gaussian smoothing, then thresholding at the per-concept quantile
+            h, w = attn_maps.shape[-2:]
+            attn_maps = F.pad(attn_maps.reshape(K * B, 1, h, w), (1, 1, 1, 1), mode="reflect")
+            attn_maps = self.smoothing(attn_maps).reshape(K, B, h, w)
+            threshold = self._batched_quantile(attn_maps.flatten(start_dim=2), thresholds, bins=threshold_bins)
+            attn_mask = (attn_maps >= threshold.to(attn_maps.dtype)[:, :, None, None]).to(guidance.dtype)
+            # resolution must match latent space dimension
+            attn_mask = F.interpolate(attn_mask.reshape(K * B, 1, h, w), (H, W)).reshape(K, B, 1, H, W)
+            if not intersect:
+                mask = attn_mask.expand(K, B, C, H, W)
+                return (guidance * mask).sum(dim=0), mask
+
+        # the magnitude summed over channels is thresholded at the per-concept quantile
+        magnitude = guidance.abs().sum(dim=2)  # [K, B, H, W]
+        threshold = self._batched_quantile(magnitude.flatten(start_dim=2), thresholds, bins=threshold_bins)
+        mask = magnitude >= threshold.to(magnitude.dtype)[:, :, None, None]
+        mask = mask.unsqueeze(2).expand(K, B, C, H, W)
+
+        if attn_maps is not None:
+            mask = mask.to(guidance.dtype) * attn_mask
+            return (guidance * mask).sum(dim=0), mask
+        guidance = torch.where(mask, guidance, torch.zeros((), dtype=guidance.dtype, device=guidance.device))
+        return guidance.sum(dim=0), mask.to(guidance.dtype)
+
+    def _stored_attn_map(self, editing_prompt: str, num_edit_tokens: int, att_res: Tuple[int, int]) -> torch.Tensor:
+        """
+        Cross-attention map of one editing prompt from the `LeditsAttentionStore`, summed over its tokens, with the
+        shape of [B, h, w].
+        """
+        out = self.attention_store.aggregate_attention(
+            attention_maps=self.attention_store.step_store,
+            prompts=self.text_cross_attention_maps,
+            res=att_res,
+            from_where=["up", "down"],
+            is_cross=True,
+            select=self.text_cross_attention_maps.index(editing_prompt),
+        )
+        attn_map = out[:, :, :, 1 : 1 + num_edit_tokens]  # 0 -> startoftext
+
+        # average over all tokens
+        if attn_map.shape[3] != num_edit_tokens:
+            raise ValueError(
+                f"Incorrect shape of attention_map. Expected size {num_edit_tokens}, but found {attn_map.shape[3]}!"
+            )
+        return torch.sum(attn_map, dim=3)
+
+    @staticmethod
+    def _active_concepts(
+        step: int,
+        n_concepts: int,
+        edit_warmup_steps: Union[int, List[int]],
+        edit_cooldown_steps: Optional[Union[int, List[int]]],
+    ) -> List[int]:
+        """
+        Indices of the edit concepts whose guidance is applied at `step`, i.e. past their warmup and before their
+        cooldown.
+        """
+        active = []
+        for c in range(n_concepts):
+            warmup = edit_warmup_steps[c] if isinstance(edit_warmup_steps, list) else edit_warmup_steps
+            if isinstance(edit_cooldown_steps, list):
+                cooldown = edit_cooldown_steps[c]
+            elif edit_cooldown_steps is None:
+                cooldown = step + 1
+            else:
+                cooldown = edit_cooldown_steps
+            if warmup <= step < cooldown:
+                active.append(c)
+        return active
+
+    def enable_fp32_vae_decoder(self):
+        r"""
+        Keep a float32 copy of the VAE for decoding with a float16 VAE that needs upcasting (`force_upcast`), instead
+        of casting all VAE weights to float32 and back on every decode. The copy holds the decoder weights in float32
+        once more; VAE tiling and slicing, see `enable_vae_tiling` and `enable_vae_slicing`, carry over to it.
+        """
+        encoder = self.vae.encoder
+        # only decoding uses the copy
+        self.vae.encoder = None
+        try:
+            self._fp32_vae_decoder = copy.deepcopy(self.vae).to(dtype=torch.float32)
+        finally:
+            self.vae.encoder = encoder
+
+    def disable_fp32_vae_decoder(self):
+        r"""
+        Release the float32 VAE copy of `enable_fp32_vae_decoder`.
+        """
+        self._fp32_vae_decoder = None
+
+    def _decode_latents(self, latents: torch.Tensor, generator: Optional[torch.Generator] = None) -> torch.Tensor:
+        """
+        Decode scaled latents with the VAE. A float16 VAE that needs upcasting decodes in float32, with the copy of
+        `enable_fp32_vae_decoder` if enabled and otherwise by casting the VAE to float32 and back.
+        """
+        vae = self.vae
+        # make sure the VAE is in float32 mode, as it overflows in float16
+        needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+        if needs_upcasting and self._fp32_vae_decoder is not None:
+            vae = self._fp32_vae_decoder
+            if vae.device != latents.device:
+                vae.to(latents.device)
+            vae.use_tiling = self.vae.use_tiling
+            vae.use_slicing = self.vae.use_slicing
+            needs_upcasting = False
+        elif needs_upcasting:
+            vae.to(dtype=torch.float32)
+
+        latents = latents.to(next(iter(vae.post_quant_conv.parameters())).dtype)
+        image = vae.decode(latents / vae.config.scaling_factor, return_dict=False, generator=generator)[0]
+
+        # cast back to fp16 if needed
+        if needs_upcasting:
+            vae.to(dtype=torch.float16)
+        return image
+
+    def _prepare_attn_capture(
+        self, capture: LEditsCrossAttnCapture, resolution: Tuple[int, int], att_res: Tuple[int, int]
+    ) -> Dict[str, Any]:
+        """
+        Hook `capture` into the cross-attention layers of the down and up blocks whose resolution is `att_res`, and
+        keep the processors of all other layers. Returns the previous processors.
+        """
+        original_attn_processors = self.unet.attn_processors
+        num_blocks = len(self.unet.config.down_block_types)
+        attn_procs = dict(original_attn_processors)
+        for name in attn_procs:
+            if "attn2" not in name:
+                continue
+            if name.startswith("down_blocks"):
+                downscale = 2 ** int(name.split(".")[1])
+            elif name.startswith("up_blocks"):
+                downscale = 2 ** (num_blocks - 1 - int(name.split(".")[1]))
+            else:
+                continue
+            if (resolution[0] // downscale, resolution[1] // downscale) == tuple(att_res):
+                attn_procs[name] = LEditsCrossAttnCaptureProcessor(capture)
+        self.unet.set_attn_processor(attn_procs)
+        return original_attn_processors
+
+    def _allocate_zs(self, shape: Tuple[int, ...], dtype: torch.dtype, zs_offload: Optional[str] = None) -> torch.Tensor:
+        """
+        Zero-initialized storage for the noise maps `zs`, on the device or offloaded to the host, see `invert`.
+        """
+        if zs_offload is None:
+            return torch.zeros(shape, device=self.device, dtype=dtype)
+        if zs_offload == "pinned":
+            return torch.zeros(shape, dtype=dtype, pin_memory=self.device.type == "cuda")
+        if zs_offload == "mmap":
+            # numpy has no bfloat16, noise maps are cast back to the latent dtype when fetched
+            np_dtype = np.float16 if dtype == torch.float16 else np.float32
+            return torch.from_numpy(np.memmap(tempfile.TemporaryFile(), dtype=np_dtype, mode="w+", shape=shape))
+        raise ValueError(f"Unknown `zs_offload`: {zs_offload}, expected `None`, 'pinned' or 'mmap'.")
+
+    def _prefetch_steps(
+        self,
+        tensors: Union[torch.Tensor, List[torch.Tensor]],
+        indices: List[int],
+        device: torch.device,
+        dtype: torch.dtype,
+    ):
+        """
+        Yield `tensors[idx]` on `device` and in `dtype` for each of `indices`, e.g. the noise maps `zs` or recorded
+        `sem_guidance`. Host tensors are copied one step ahead, on a side stream on CUDA, so that the copy overlaps
+        with the UNet pass of the current step.
+        """
+        if isinstance(tensors, torch.Tensor) and tensors.device == device and tensors.dtype == dtype:
+            for idx in indices:
+                yield tensors[idx]
+            return
+        zs = tensors
+
+        stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+        def fetch(idx):
+            if stream is None:
+                return zs[idx].to(device=device, dtype=dtype)
+            with torch.cuda.stream(stream):
+                return zs[idx].to(device=device, dtype=dtype, non_blocking=True)
+
+        next_z = fetch(indices[0]) if len(indices) > 0 else None
+        for k in range(len(indices)):
+            z = next_z
+            if stream is not None:
+                torch.cuda.current_stream(device).wait_stream(stream)
+                z.record_stream(torch.cuda.current_stream(device))
+            if k + 1 < len(indices):
+                next_z = fetch(indices[k + 1])
+            yield z
+
 # Copied from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl.rescale_noise_cfg
 def rescale_noise_cfg(noise_cfg, noise_pred_text, guidance_rescale=0.0):
     r"""
@@ -1095,33 +2209,42 @@ def compute_noise(scheduler, *args):
 
 ##########################################
 
-import torch
-import PIL
-import requests
-
-pipe = LEditsPPPipelineStableDiffusionXLScaling.from_pretrained(
-     "stabilityai/stable-diffusion-xl-base-1.0", torch_dtype=torch.float16,
-    use_safetensors=True,
-    variant="fp16",
-    safety_checker = None
-)
-pipe = pipe.to("cuda")
-
-torch.manual_seed(42)
+if __name__ == "__main__":
+    pipe = LEditsPPPipelineStableDiffusionXLScaling.from_pretrained(
+         "stabilityai/stable-diffusion-xl-base-1.0", torch_dtype=torch.float16,
+        use_safetensors=True,
+        variant="fp16",
+        safety_checker = None
+    )
+    pipe = pipe.to("cuda")
+    # decode with a float32 copy of the fp16 VAE instead of recasting it on every call
+    pipe.enable_fp32_vae_decoder()
 
-image = Image.open("./examples/white_horse2.png").convert("RGB").resize((1024, 1024))
+    torch.manual_seed(42)
 
+    image = Image.open("./examples/white_horse2.png").convert("RGB").resize((1024, 1024))
 
-_ = pipe.invert(image=image, source_prompt="", num_inversion_steps=50, source_guidance_scale=3.5, skip=0.)
+    # repeated runs with the same image and inversion settings skip the inversion
+    inversion_cache = LEditsInversionCache("./inversion_cache")
+    _ = pipe.invert(
+        image=image,
+        source_prompt="",
+        num_inversion_steps=50,
+        source_guidance_scale=3.5,
+        skip=0.,
+        generator=torch.Generator("cuda").manual_seed(42),
+        inversion_cache=inversion_cache,
+        vae_reconstruction=False,
+    )
 
-edited_image = pipe(
-    editing_prompt=["A jumping horse.",""],
-    reverse_editing_direction=[False],
-    edit_guidance_scale=[15.0],
-    edit_threshold=[0.9],
-    frequency_scaling=True,
-    scale_high=1.5,
-    scale_low=1,
-    freq_cutoff=20,
-).images[0]
-edited_image.save("edited_horse.jpg")
\ No newline at end of file
+    edited_image = pipe(
+        editing_prompt=["A jumping horse.",""],
+        reverse_editing_direction=[False],
+        edit_guidance_scale=[15.0],
+        edit_threshold=[0.9],
+        frequency_scaling=True,
+        scale_high=1.5,
+        scale_low=1,
+        freq_cutoff=20,
+    ).images[0]
+    edited_image.save("edited_horse.jpg")
@@ -18,17 +18,38 @@
 # --------------------------------------------------------------------------
 
 
+import functools
+import hashlib
+import json
 import logging
 import math
-from typing import Dict, Union
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Sequence, Tuple, Union
 
-import matplotlib
 import numpy as np
 import torch
+import torch.nn.functional as F
+from huggingface_hub import hf_hub_download
 from PIL import Image
 from PIL.Image import Resampling
+from safetensors.torch import load_file, save_file
 from scipy.optimize import minimize
-from torch.utils.data import DataLoader, TensorDataset
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
@@ -40,6 +61,12 @@ from diffusers import (
     UNet2DConditionModel,
 )
 from diffusers.utils import BaseOutput, check_min_version
+from diffusers.utils.torch_utils import randn_tensor
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 
 # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
@@ -94,6 +121,50 @@ def Fourier_filter(x, scale_low=1.0, scale_high=1.5, freq_cutoff=20):
     return x_filtered
 
 
+class FourierFilterWorkspace:
+    """
+    Reusable buffers for `Fourier_filter` on same-shaped inputs, e.g. the noise predictions of a denoising loop.
+
+    The frequency mask is built once, already `ifftshift`-ed, so the spectrum is scaled without shifting it back
+    and forth. The spectra are computed into preallocated complex buffers and the result is written into `out`, so
+    repeated calls do not allocate.
+    """
+
+    def __init__(self, scale_low=1.0, scale_high=1.5, freq_cutoff=20):
+        self.scale_low = scale_low
+        self.scale_high = scale_high
+        self.freq_cutoff = freq_cutoff
+        self._shape = None
+
+    def _allocate(self, x):
+        B, C, H, W = x.shape
+        crow, ccol = H // 2, W // 2
+        mask = torch.full((H, W), self.scale_high, device=x.device)
+        mask[crow - self.freq_cutoff : crow + self.freq_cutoff, ccol - self.freq_cutoff : ccol + self.freq_cutoff] = (
+            self.scale_low
+        )
+        self._mask = fft.ifftshift(mask, dim=(-2, -1))
+        self._x = None if x.dtype == torch.float32 else torch.empty(x.shape, device=x.device)
+        self._freq = torch.empty(x.shape, dtype=torch.complex64, device=x.device)
+        self._filtered = torch.empty_like(self._freq)
+        self._shape = (x.shape, x.dtype, x.device)
+
+    def __call__(self, x: torch.Tensor, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Filter `x` of shape (B, C, H, W) into `out` (may be `x` itself), or into a new tensor.
+        """
+        if self._shape != (x.shape, x.dtype, x.device):
+            self._allocate(x)
+        if out is None:
+            out = torch.empty_like(x)
+        x32 = x if self._x is None else self._x.copy_(x)
+
+        fft.fftn(x32, dim=(-2, -1), out=self._freq)
+        self._freq.mul_(self._mask)
+        fft.ifftn(self._freq, dim=(-2, -1), out=self._filtered)
+        return out.copy_(self._filtered.real)
+
+
 class MarigoldDepthOutput(BaseOutput):
     """
     Output class for Marigold monocular depth prediction pipeline.
@@ -105,11 +176,117 @@ class MarigoldDepthOutput(BaseOutput):
             Colorized depth map, with the shape of [3, H, W] and values in [0, 1].
         uncertainty (`None` or `np.ndarray`):
             Uncalibrated uncertainty(MAD, median absolute deviation) coming from ensembling.
+        ensemble_size (`None` or `int`):
+            Number of ensemble members the prediction was computed from.
     """
 
     depth_np: np.ndarray
     depth_colored: Union[None, Image.Image]
     uncertainty: Union[None, np.ndarray]
+    ensemble_size: Union[None, int] = None
+
+
+class MarigoldDepthCache:
+    """
+    On-disk cache of Marigold predictions, content-addressed by the preprocessed image and the inference settings.
+
+    Every entry is a directory holding `depth.npy`, `uncertainty.npy` (if any) and `meta.json`. Arrays are returned
+    memory-mapped (read-only), so a hit neither runs nor needs any model component. Entries are evicted least
+    recently used first once the cache grows beyond `max_bytes`.
+
+    Args:
+        cache_dir (`str`):
+            Directory of the cache, created if missing.
+        max_bytes (`int`, *optional*, defaults to 10 GiB):
+            Size limit of all entries together.
+        namespace (`str`, *optional*):
+            Identifies the model in the keys. Required for pipelines not loaded with `from_pretrained`, which have no
+            model name to key on; the cache is not used for those otherwise.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 10 * 1024**3, namespace: Optional[str] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(image: np.ndarray, **settings) -> str:
+        """
+        Hash of the preprocessed uint8 image and all settings that influence the prediction.
+        """
+        h = hashlib.sha256()
+        h.update(f"{image.shape}|{image.dtype}".encode())
+        h.update(np.ascontiguousarray(image).data)
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[MarigoldDepthOutput]:
+        """
+        Look up a prediction. Returns `None` on a miss, otherwise an output without `depth_colored`.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            depth_np = np.load(os.path.join(entry, "depth.npy"), mmap_mode="r")
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+            uncertainty = None
+            if meta.get("uncertainty", False):
+                uncertainty = np.load(os.path.join(entry, "uncertainty.npy"), mmap_mode="r")
+            # mark as recently used
+            os.utime(entry)
+        except (OSError, ValueError):
+            # missing, or evicted by another process while reading
+            return None
+        return MarigoldDepthOutput(
+            depth_np=depth_np,
+            depth_colored=None,
+            uncertainty=uncertainty,
+            ensemble_size=meta.get("ensemble_size"),
+        )
+
+    def put(
+        self,
+        key: str,
+        depth_np: np.ndarray,
+        uncertainty: Union[None, np.ndarray] = None,
+        ensemble_size: Union[None, int] = None,
+    ):
+        """
+        Store a prediction, then evict least recently used entries beyond `max_bytes`.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            np.save(os.path.join(tmp_entry, "depth.npy"), depth_np)
+            if uncertainty is not None:
+                np.save(os.path.join(tmp_entry, "uncertainty.npy"), uncertainty)
+            with open(os.path.join(tmp_entry, "meta.json"), "w") as f:
+                json.dump({"uncertainty": uncertainty is not None, "ensemble_size": ensemble_size}, f)
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # entry written concurrently by another process, or disk full
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".tmp-") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except OSError:
+                continue
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
 
 
 def get_pil_resample_method(method_str: str) -> Resampling:
@@ -125,6 +302,125 @@ def get_pil_resample_method(method_str: str) -> Resampling:
         return resample_method
 
 
+class MarigoldStreamingEnsemble:
+    """
+    Running ensemble of affine-invariant depth predictions, with memory independent of the ensemble size.
+
+    Each member is aligned to the running mean by a closed-form least-squares scale and shift, and then folded into
+    Welford mean/variance accumulators. The first member is only min-max normalized, as in the initial guess of
+    `MarigoldPipeline.ensemble_depths`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, depth_preds: torch.Tensor):
+        """
+        Fold a batch of depth predictions into the running statistics.
+
+        Args:
+            depth_preds (`torch.Tensor`):
+                Depth predictions, with the shape of [B, 1, H, W] or [B, H, W].
+        """
+        depth_preds = depth_preds.reshape(-1, *depth_preds.shape[-2:]).to(torch.float32)
+        for depth in depth_preds:
+            if self.count == 0:
+                _min, _max = depth.min(), depth.max()
+                aligned = (depth - _min) / (_max - _min)
+                self.mean = torch.zeros_like(aligned)
+                self.m2 = torch.zeros_like(aligned)
+            else:
+                # least-squares scale and shift onto the running mean
+                d_mean = depth.mean()
+                ref_mean = self.mean.mean()
+                d_centered = depth - d_mean
+                s = (d_centered * (self.mean - ref_mean)).sum() / (d_centered**2).sum().clamp_min(1e-12)
+                aligned = s * d_centered + ref_mean
+
+            self.count += 1
+            delta = aligned - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (aligned - self.mean)
+
+    def finalize(self):
+        """
+        Returns:
+            `Tuple[torch.Tensor, torch.Tensor]`: Ensembled depth map scaled to [0, 1], and the std of the aligned
+            members as uncertainty (`None` for a single member).
+        """
+        if self.count == 0:
+            raise RuntimeError("No depth predictions have been added to the ensemble.")
+        _min = torch.min(self.mean)
+        _max = torch.max(self.mean)
+        aligned_images = (self.mean - _min) / (_max - _min)
+        if self.count > 1:
+            uncertainty = torch.sqrt(self.m2 / (self.count - 1)) / (_max - _min)
+        else:
+            uncertainty = None
+        return aligned_images, uncertainty
+
+
+@functools.lru_cache(maxsize=None)
+def _colormap_lut(cmap: str, lut_size: int = 256) -> np.ndarray:
+    """
+    uint8 RGB lookup table of a matplotlib colormap, with the shape of [lut_size + 1, 3]. The last entry is the "bad"
+    color of the colormap, for NaN depth.
+    """
+    import matplotlib
+
+    cm = matplotlib.colormaps[cmap]
+    if cm.N != lut_size:
+        cm = cm.resampled(lut_size)
+    lut = np.concatenate([cm(np.arange(lut_size), bytes=True), cm(np.array([np.nan]), bytes=True)])[:, 0:3]
+    lut.setflags(write=False)
+    return lut
+
+
+@functools.lru_cache(maxsize=None)
+def _colormap_lut_tensor(cmap: str, lut_size: int, device: torch.device) -> torch.Tensor:
+    return torch.from_numpy(_colormap_lut(cmap, lut_size).copy()).to(device)
+
+
+class _PeakRSSMonitor:
+    """
+    Context manager sampling the resident set size of the current process in a background thread.
+    """
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rss(self) -> int:
+        if psutil is not None:
+            return psutil.Process().memory_info().rss
+        import resource
+
+        # without psutil only the lifetime maximum is available (KiB on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = self._rss()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+        return False
+
+
 class MarigoldPipeline(DiffusionPipeline):
     """
     Pipeline for monocular depth estimation using Marigold: https://marigoldmonodepth.github.io.
@@ -140,22 +436,36 @@ class MarigoldPipeline(DiffusionPipeline):
             to and from latent representations.
         scheduler (`DDIMScheduler`):
             A scheduler to be used in combination with `unet` to denoise the encoded image latents.
-        text_encoder (`CLIPTextModel`):
-            Text-encoder, for empty text embedding.
-        tokenizer (`CLIPTokenizer`):
+        text_encoder (`CLIPTextModel`, *optional*):
+            Text-encoder, for empty text embedding. Only needed if no persisted empty text embedding is available,
+            loaded on demand otherwise.
+        tokenizer (`CLIPTokenizer`, *optional*):
             CLIP tokenizer.
     """
 
     rgb_latent_scale_factor = 0.18215
     depth_latent_scale_factor = 0.18215
 
+    _optional_components = ["text_encoder", "tokenizer"]
+    # constant empty prompt embedding, saved next to the model components
+    empty_text_embed_name = "empty_text_embed.safetensors"
+
+    # measured batch size plans, keyed by resolution bucket, dtype and device
+    batch_plan_cache_path = os.environ.get(
+        "MARIGOLD_BATCH_PLAN_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "marigold", "batch_plans.json")
+    )
+    # edge length (pixel) of the square resolution buckets, and number of plans kept (least recently measured dropped)
+    batch_plan_bucket = 128
+    max_batch_plans = 64
+    _batch_plans = None
+
     def __init__(
         self,
         unet: UNet2DConditionModel,
         vae: AutoencoderKL,
         scheduler: DDIMScheduler,
-        text_encoder: CLIPTextModel,
-        tokenizer: CLIPTokenizer,
+        text_encoder: Optional[CLIPTextModel] = None,
+        tokenizer: Optional[CLIPTokenizer] = None,
     ):
         super().__init__()
 
@@ -168,6 +478,60 @@ class MarigoldPipeline(DiffusionPipeline):
         )
 
         self.empty_text_embed = None
+        # batch size limits after out-of-memory errors in this run, keyed like the batch size plans
+        self._oom_batch_limits = {}
+
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, **kwargs):
+        """
+        Load the pipeline like [`DiffusionPipeline.from_pretrained`].
+
+        If the checkpoint ships a persisted empty text embedding (see `save_pretrained`), the text encoder and the
+        tokenizer are not loaded unless passed explicitly.
+        """
+        empty_text_embed = cls._load_empty_text_embed(pretrained_model_name_or_path, **kwargs)
+        if empty_text_embed is not None:
+            kwargs.setdefault("text_encoder", None)
+            kwargs.setdefault("tokenizer", None)
+        pipe = super().from_pretrained(pretrained_model_name_or_path, **kwargs)
+        pipe.empty_text_embed = empty_text_embed
+        return pipe
+
+    def save_pretrained(self, save_directory, **kwargs):
+        """
+        Save the pipeline like [`DiffusionPipeline.save_pretrained`], together with the empty text embedding.
+        """
+        super().save_pretrained(save_directory, **kwargs)
+        if self.empty_text_embed is None:
+            self._encode_empty_text()
+        save_file(
+            {"empty_text_embed": self.empty_text_embed.detach().cpu().contiguous()},
+            os.path.join(save_directory, self.empty_text_embed_name),
+        )
+
+    @classmethod
+    def _load_empty_text_embed(cls, pretrained_model_name_or_path, **kwargs) -> Optional[torch.Tensor]:
+        """
+        Load the persisted empty text embedding from a local directory or the Hub, `None` if there is none.
+        """
+        if os.path.isdir(pretrained_model_name_or_path):
+            path = os.path.join(pretrained_model_name_or_path, cls.empty_text_embed_name)
+            if not os.path.isfile(path):
+                return None
+        else:
+            try:
+                path = hf_hub_download(
+                    pretrained_model_name_or_path,
+                    cls.empty_text_embed_name,
+                    revision=kwargs.get("revision"),
+                    cache_dir=kwargs.get("cache_dir"),
+                    token=kwargs.get("token"),
+                    local_files_only=kwargs.get("local_files_only", False),
+                )
+            except Exception as e:
+                logging.info(f"No persisted empty text embedding found ({e}), using the text encoder instead.")
+                return None
+        return load_file(path)["empty_text_embed"]
 
     @torch.no_grad()
     def __call__(
@@ -184,6 +548,17 @@ class MarigoldPipeline(DiffusionPipeline):
         show_progress_bar: bool = True,
         ensemble_kwargs: Dict = None,
         frequency_scaling: bool = False,
+        streaming_ensemble: bool = False,
+        adaptive_ensemble: bool = False,
+        adaptive_tol: float = 0.01,
+        tile_size: int = 0,
+        tile_overlap: int = 128,
+        memory_budget: float = 0.9,
+        result_cache: Optional[MarigoldDepthCache] = None,
+        postprocess_executor: Optional[Executor] = None,
+        device_postprocess: bool = False,
+        output_uint16: bool = False,
+        worker_pool: Optional["MarigoldEnsembleWorkerPool"] = None,
     ) -> MarigoldDepthOutput:
         """
         Function invoked when calling the pipeline.
@@ -205,7 +580,8 @@ class MarigoldPipeline(DiffusionPipeline):
                 Number of predictions to be ensembled.
             batch_size (`int`, *optional*, defaults to `0`):
                 Inference batch size, no bigger than `num_ensemble`.
-                If set to 0, the script will automatically decide the proper batch size.
+                If set to 0, the script will automatically decide the proper batch size by measuring the memory
+                footprint of a single denoising step, see `memory_budget`.
             seed (`int`, *optional*, defaults to `None`)
                 Reproducibility seed.
             show_progress_bar (`bool`, *optional*, defaults to `True`):
@@ -214,12 +590,49 @@ class MarigoldPipeline(DiffusionPipeline):
                 Colormap used to colorize the depth map.
             ensemble_kwargs (`dict`, *optional*, defaults to `None`):
                 Arguments for detailed ensembling settings.
+            frequency_scaling (`bool`, *optional*, defaults to `False`):
+                Apply FreSca frequency-dependent scaling to the noise prediction.
+            streaming_ensemble (`bool`, *optional*, defaults to `False`):
+                Fold each decoded batch into running mean/std statistics instead of stacking all ensemble members,
+                so that peak memory does not grow with `ensemble_size`. Uses mean reduction with std as uncertainty,
+                `ensemble_kwargs` are ignored.
+            adaptive_ensemble (`bool`, *optional*, defaults to `False`):
+                Treat `ensemble_size` as an upper bound and stop adding ensemble batches once the standard error of
+                the ensembled prediction (mean std of the aligned members divided by the square root of their
+                number) falls to `adaptive_tol`.
+            adaptive_tol (`float`, *optional*, defaults to `0.01`):
+                Standard error, relative to the depth range, at which adaptive ensembling stops.
+            tile_size (`int`, *optional*, defaults to `0`):
+                If larger than 0 and the processed image exceeds it, predict depth on overlapping square tiles of
+                this edge length (pixel) and stitch them, so that memory is bounded by the tile size. Mainly useful
+                with `processing_res=0`. Streaming and adaptive ensembling do not apply to tiled inference.
+            tile_overlap (`int`, *optional*, defaults to `128`):
+                Overlap between neighboring tiles (pixel), used to align and blend their affine-invariant depth.
+            memory_budget (`float`, *optional*, defaults to `0.9`):
+                Fraction of the currently free device memory (host memory on CPU) that automatic batch sizing may
+                plan for.
+            result_cache (`MarigoldDepthCache`, *optional*, defaults to `None`):
+                On-disk cache to look the prediction up in before running any model, and to store it in otherwise.
+                Cached `depth_np` and `uncertainty` are read-only memory-mapped arrays.
+            postprocess_executor (`concurrent.futures.Executor`, *optional*, defaults to `None`):
+                If given, the host-side post-processing (resize, clip, colorize, caching) is submitted to this
+                executor and a `Future` of the output is returned instead, see `pipelined_call`.
+            device_postprocess (`bool`, *optional*, defaults to `False`):
+                Normalize, resize (antialiased `F.interpolate` instead of PIL), clip, quantize and colorize the
+                prediction on the device, see `postprocess_depth_device`. Only the final arrays are copied to the
+                host.
+            output_uint16 (`bool`, *optional*, defaults to `False`):
+                Return `depth_np` quantized to uint16, with depth values in the range of [0, 65535].
+            worker_pool (`MarigoldEnsembleWorkerPool`, *optional*, defaults to `None`):
+                Shard every batch of ensemble members across the processes of this pool (CPU only). Without
+                `batch_size`, the whole ensemble is one batch.
         Returns:
             `MarigoldDepthOutput`: Output class for Marigold monocular depth prediction pipeline, including:
             - **depth_np** (`np.ndarray`) Predicted depth map, with depth values in the range of [0, 1]
             - **depth_colored** (`PIL.Image.Image`) Colorized depth map, with the shape of [3, H, W] and values in [0, 1], None if `color_map` is `None`
             - **uncertainty** (`None` or `np.ndarray`) Uncalibrated uncertainty(MAD, median absolute deviation)
                     coming from ensembling. None if `ensemble_size = 1`
+            - **ensemble_size** (`int`) Number of ensemble members actually used
         """
 
         device = self.device
@@ -247,55 +660,153 @@ class MarigoldPipeline(DiffusionPipeline):
         input_image = input_image.convert("RGB")
         image = np.asarray(input_image)
 
+        # ----------------- Result cache -----------------
+        model_name = self.config.get("_name_or_path") or None
+        if result_cache is not None and model_name is None and result_cache.namespace is None:
+            logging.warning(
+                "The pipeline has no model name to key the result cache on, pass a `namespace` to "
+                "`MarigoldDepthCache` to use it. Running without the cache."
+            )
+            result_cache = None
+        if result_cache is not None:
+            cache_key = result_cache.make_key(
+                image,
+                model=model_name,
+                namespace=result_cache.namespace,
+                dtype=self.dtype,
+                scheduler=type(self.scheduler).__name__,
+                scheduler_config=dict(self.scheduler.config),
+                input_size=input_size,
+                denoising_steps=denoising_steps,
+                ensemble_size=ensemble_size,
+                batch_size=batch_size,
+                seed=seed,
+                processing_res=processing_res,
+                match_input_res=match_input_res,
+                resample_method=resample_method,
+                frequency_scaling=frequency_scaling,
+                ensemble_kwargs=ensemble_kwargs,
+                streaming_ensemble=streaming_ensemble,
+                adaptive_ensemble=adaptive_ensemble,
+                adaptive_tol=adaptive_tol,
+                tile_size=tile_size,
+                tile_overlap=tile_overlap,
+                device_postprocess=device_postprocess,
+                output_uint16=output_uint16,
+            )
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                if color_map is not None:
+                    max_depth = 65535.0 if cached.depth_np.dtype == np.uint16 else 1.0
+                    cached.depth_colored = Image.fromarray(
+                        self.colorize_depth_lut(cached.depth_np, cmap=color_map, max_depth=max_depth)
+                    )
+                if postprocess_executor is not None:
+                    future = Future()
+                    future.set_result(cached)
+                    return future
+                return cached
+        else:
+            cache_key = None
+
         # Normalize rgb values
-        rgb = np.transpose(image, (2, 0, 1))  # [H, W, rgb] -> [rgb, H, W]
-        rgb_norm = rgb / 255.0 * 2.0 - 1.0  #  [0, 255] -> [-1, 1]
-        rgb_norm = torch.from_numpy(rgb_norm).to(self.dtype)
-        rgb_norm = rgb_norm.to(device)
-        assert rgb_norm.min() >= -1.0 and rgb_norm.max() <= 1.0
+        rgb_norm = self.rgb_to_device(image, device=device, dtype=self.dtype)
 
         # ----------------- Predicting depth -----------------
-        # Batch repeated input image
-        duplicated_rgb = torch.stack([rgb_norm] * ensemble_size)
-        single_rgb_dataset = TensorDataset(duplicated_rgb)
-        if batch_size > 0:
-            _bs = batch_size
-        else:
-            _bs = self._find_batch_size(
+        if tile_size > 0 and max(rgb_norm.shape[1:]) > tile_size:
+            # ----------------- Tiled inference -----------------
+            depth_pred, pred_uncert = self._tiled_infer(
+                rgb_norm=rgb_norm,
+                tile_size=tile_size,
+                tile_overlap=tile_overlap,
                 ensemble_size=ensemble_size,
-                input_res=max(rgb_norm.shape[1:]),
-                dtype=self.dtype,
+                batch_size=batch_size,
+                denoising_steps=denoising_steps,
+                seed=seed,
+                show_progress_bar=show_progress_bar,
+                frequency_scaling=frequency_scaling,
+                ensemble_kwargs=ensemble_kwargs,
+                memory_budget=memory_budget,
             )
-
-        single_rgb_loader = DataLoader(single_rgb_dataset, batch_size=_bs, shuffle=False)
-
-        # Predict depth maps (batched)
-        depth_pred_ls = []
-        if show_progress_bar:
-            iterable = tqdm(single_rgb_loader, desc=" " * 2 + "Inference batches", leave=False)
         else:
-            iterable = single_rgb_loader
-        for batch in iterable:
-            (batched_img,) = batch
-            depth_pred_raw = self.single_infer(
-                rgb_in=batched_img,
-                num_inference_steps=denoising_steps,
-                show_pbar=show_progress_bar,
+            if batch_size > 0:
+                _bs = batch_size
+            elif worker_pool is not None:
+                _bs = ensemble_size
+                if adaptive_ensemble:
+                    _bs = min(_bs, max(worker_pool.num_workers, math.ceil(ensemble_size / 4)))
+            else:
+                _bs = self._plan_batch_size(
+                    ensemble_size=ensemble_size,
+                    input_shape=tuple(rgb_norm.shape[1:]),
+                    memory_budget=memory_budget,
+                )
+                if adaptive_ensemble:
+                    # smaller batches give the stopping criterion a chance to trigger
+                    _bs = min(_bs, max(2, math.ceil(ensemble_size / 4)))
+
+            # Predict depth maps (batched)
+            depth_batches = self._iter_depth_batches(
+                rgb_norm=rgb_norm,
+                ensemble_size=ensemble_size,
+                batch_size=_bs,
+                denoising_steps=denoising_steps,
                 seed=seed,
+                show_progress_bar=show_progress_bar,
                 frequency_scaling=frequency_scaling,
+                worker_pool=worker_pool,
             )
-            depth_pred_ls.append(depth_pred_raw.detach())
-        depth_preds = torch.concat(depth_pred_ls, dim=0).squeeze()
-        torch.cuda.empty_cache()  # clear vram cache for ensembling
 
-        # ----------------- Test-time ensembling -----------------
-        if ensemble_size > 1:
-            depth_pred, pred_uncert = self.ensemble_depths(depth_preds, **(ensemble_kwargs or {}))
-        else:
-            depth_pred = depth_preds
-            pred_uncert = None
+            if adaptive_ensemble and ensemble_size > 1:
+                # ----------------- Adaptive ensembling -----------------
+                depth_pred, pred_uncert, ensemble_size = self._adaptive_ensemble(
+                    depth_batches,
+                    tol=adaptive_tol,
+                    streaming_ensemble=streaming_ensemble,
+                    ensemble_kwargs=ensemble_kwargs,
+                )
+            elif streaming_ensemble and ensemble_size > 1:
+                # ----------------- Streaming ensembling -----------------
+                ensemble = MarigoldStreamingEnsemble()
+                for depth_pred_raw in depth_batches:
+                    ensemble.update(depth_pred_raw)
+                depth_pred, pred_uncert = ensemble.finalize()
+            else:
+                depth_preds = torch.concat(list(depth_batches), dim=0).squeeze()
+                torch.cuda.empty_cache()  # clear vram cache for ensembling
+
+                # ----------------- Test-time ensembling -----------------
+                if ensemble_size > 1:
+                    depth_pred, pred_uncert = self.ensemble_depths(depth_preds, **(ensemble_kwargs or {}))
+                else:
+                    depth_pred = depth_preds
+                    pred_uncert = None
 
         # ----------------- Post processing -----------------
+        if device_postprocess:
+            depth_pred, depth_colored = self.postprocess_depth_device(
+                depth_pred,
+                output_size=input_size if match_input_res else None,
+                resample_method=resample_method,
+                color_map=color_map,
+                output_uint16=output_uint16,
+            )
+            if pred_uncert is not None:
+                pred_uncert = pred_uncert.cpu().numpy().astype(np.float32)
+            if result_cache is not None:
+                result_cache.put(cache_key, depth_pred, pred_uncert, ensemble_size=ensemble_size)
+            output = MarigoldDepthOutput(
+                depth_np=depth_pred,
+                depth_colored=None if depth_colored is None else Image.fromarray(depth_colored),
+                uncertainty=pred_uncert,
+                ensemble_size=ensemble_size,
+            )
+            if postprocess_executor is not None:
+                future = Future()
+                future.set_result(output)
+                return future
+            return output
+
         # Scale prediction to [0, 1]
         min_d = torch.min(depth_pred)
         max_d = torch.max(depth_pred)
@@ -303,7 +814,42 @@ class MarigoldPipeline(DiffusionPipeline):
 
         # Convert to numpy
         depth_pred = depth_pred.cpu().numpy().astype(np.float32)
+        if pred_uncert is not None:
+            pred_uncert = pred_uncert.cpu().numpy().astype(np.float32)
+
+        postprocess_kwargs = dict(
+            depth_pred=depth_pred,
+            pred_uncert=pred_uncert,
+            ensemble_size=ensemble_size,
+            input_size=input_size,
+            match_input_res=match_input_res,
+            resample_method=resample_method,
+            color_map=color_map,
+            result_cache=result_cache,
+            cache_key=cache_key,
+            output_uint16=output_uint16,
+        )
+        if postprocess_executor is not None:
+            return postprocess_executor.submit(self._postprocess_depth, **postprocess_kwargs)
+        return self._postprocess_depth(**postprocess_kwargs)
 
+    def _postprocess_depth(
+        self,
+        depth_pred: np.ndarray,
+        pred_uncert: Union[None, np.ndarray],
+        ensemble_size: int,
+        input_size: Tuple[int, int],
+        match_input_res: bool,
+        resample_method: Resampling,
+        color_map: Union[None, str],
+        result_cache: Optional[MarigoldDepthCache] = None,
+        cache_key: Optional[str] = None,
+        output_uint16: bool = False,
+    ) -> MarigoldDepthOutput:
+        """
+        Host-side post-processing of a normalized depth prediction. Does not touch any device memory, so it can
+        run in a worker thread while the next prediction is denoised.
+        """
         # Resize back to original resolution
         if match_input_res:
             pred_img = Image.fromarray(depth_pred)
@@ -312,14 +858,16 @@ class MarigoldPipeline(DiffusionPipeline):
 
         # Clip output range
         depth_pred = depth_pred.clip(0, 1)
+        if output_uint16:
+            depth_pred = (depth_pred * 65535.0).round().astype(np.uint16)
+
+        if result_cache is not None:
+            result_cache.put(cache_key, depth_pred, pred_uncert, ensemble_size=ensemble_size)
 
         # Colorize
         if color_map is not None:
-            depth_colored = self.colorize_depth_maps(
-                depth_pred, 0, 1, cmap=color_map
-            ).squeeze()  # [3, H, W], value in (0, 1)
-            depth_colored = (depth_colored * 255).astype(np.uint8)
-            depth_colored_hwc = self.chw2hwc(depth_colored)
+            max_depth = 65535.0 if output_uint16 else 1.0
+            depth_colored_hwc = self.colorize_depth_lut(depth_pred, cmap=color_map, max_depth=max_depth)  # [H, W, 3]
             depth_colored_img = Image.fromarray(depth_colored_hwc)
         else:
             depth_colored_img = None
@@ -328,8 +876,443 @@ class MarigoldPipeline(DiffusionPipeline):
             depth_np=depth_pred,
             depth_colored=depth_colored_img,
             uncertainty=pred_uncert,
+            ensemble_size=ensemble_size,
         )
 
+    def pipelined_call(
+        self,
+        input_images: Iterable[Image.Image],
+        num_workers: int = 2,
+        max_in_flight: int = 4,
+        callback: Optional[Callable[[int, MarigoldDepthOutput], Any]] = None,
+        **kwargs,
+    ) -> Iterator[MarigoldDepthOutput]:
+        """
+        Predict depth for a stream of images, overlapping the host-side post-processing of image k with the
+        denoising of the following images.
+
+        Denoising runs in the calling thread. Post-processing, and `callback` if given, run on a pool of worker
+        threads, with at most `max_in_flight` images waiting for post-processing. Outputs are identical to calling
+        the pipeline on every image and are yielded in input order.
+
+        Args:
+            input_images (`Iterable[Image]`):
+                Input RGB (or gray-scale) images.
+            num_workers (`int`, *optional*, defaults to `2`):
+                Number of post-processing threads.
+            max_in_flight (`int`, *optional*, defaults to `4`):
+                Maximum number of images whose post-processing is pending.
+            callback (`Callable[[int, MarigoldDepthOutput], Any]`, *optional*):
+                Called in the worker thread with the input index and the output, e.g. to encode and save it.
+            kwargs:
+                Arguments passed to `__call__` for every image.
+
+        Returns:
+            Iterator of `MarigoldDepthOutput`, in input order.
+        """
+
+        def finish(i, output_future):
+            output = output_future.result()
+            if callback is not None:
+                callback(i, output)
+            return output
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = deque()
+            for i, input_image in enumerate(input_images):
+                output_future = self(input_image, postprocess_executor=executor, **kwargs)
+                if callback is not None:
+                    output_future = executor.submit(finish, i, output_future)
+                pending.append(output_future)
+                while len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @staticmethod
+    def rgb_to_device(image: np.ndarray, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        """
+        Move an uint8 RGB image to the device and normalize it there.
+
+        Only the uint8 buffer is transferred, through pinned memory when the device is a GPU. The permutation and
+        normalization run in the target dtype on the device, without any host synchronization.
+
+        Args:
+            image (`np.ndarray`):
+                RGB image with the shape of [H, W, 3] and dtype uint8.
+            device (`torch.device`):
+                Target device.
+            dtype (`torch.dtype`):
+                Target dtype.
+
+        Returns:
+            `torch.Tensor`: Normalized image with the shape of [3, H, W] and values in [-1, 1].
+        """
+        device = torch.device(device)
+        if device.type == "cuda":
+            rgb = torch.empty(image.shape, dtype=torch.uint8, pin_memory=True)
+            rgb.numpy()[...] = image
+            rgb = rgb.to(device, non_blocking=True)
+        else:
+            # PIL arrays are read-only
+            rgb = torch.from_numpy(np.require(image, requirements="W")).to(device)
+        rgb_norm = rgb.permute(2, 0, 1).to(dtype, memory_format=torch.contiguous_format)  # [H, W, rgb] -> [rgb, H, W]
+        return rgb_norm.mul_(2.0 / 255.0).sub_(1.0)  #  [0, 255] -> [-1, 1]
+
+    @torch.no_grad()
+    def video_depth(
+        self,
+        frames: Iterable[Image.Image],
+        denoising_steps: int = 10,
+        ensemble_size: int = 10,
+        video_ensemble_size: int = 3,
+        warm_start_strength: float = 0.5,
+        processing_res: int = 768,
+        match_input_res: bool = True,
+        resample_method: str = "bilinear",
+        batch_size: int = 0,
+        seed: Union[int, None] = None,
+        color_map: str = "Spectral",
+        show_progress_bar: bool = True,
+        ensemble_kwargs: Dict = None,
+        frequency_scaling: bool = False,
+    ) -> Iterator[MarigoldDepthOutput]:
+        """
+        Predict depth for the frames of a video, warm-starting every frame from the latents of the previous one.
+
+        The first frame is denoised from pure noise with `ensemble_size` members. Every following frame starts from
+        the final depth latents of the previous frame, noised to an intermediate timestep, runs only the last
+        `warm_start_strength` fraction of the `denoising_steps` steps, and ensembles `video_ensemble_size` members.
+        This needs several times fewer UNet passes per frame and keeps consecutive predictions consistent.
+        Frames of a different resolution than the previous one are denoised from noise again.
+
+        Args:
+            frames (`Iterable[Image]`):
+                Input video frames, in order.
+            denoising_steps (`int`, *optional*, defaults to `10`):
+                Number of denoising steps of a full prediction.
+            ensemble_size (`int`, *optional*, defaults to `10`):
+                Number of members of the first frame.
+            video_ensemble_size (`int`, *optional*, defaults to `3`):
+                Number of members of the warm-started frames, at most `ensemble_size`.
+            warm_start_strength (`float`, *optional*, defaults to `0.5`):
+                Fraction of `denoising_steps` run for warm-started frames. Lower values are faster and more stable
+                over time, higher values follow the content of the current frame more closely.
+            batch_size (`int`, *optional*, defaults to `0`):
+                Inference batch size of the first frame, see `__call__`.
+
+            See `__call__` for the remaining arguments.
+
+        Returns:
+            Iterator of `MarigoldDepthOutput`, one per frame.
+        """
+        assert 1 <= video_ensemble_size <= ensemble_size
+        assert 0.0 < warm_start_strength <= 1.0
+        self._check_inference_step(denoising_steps)
+
+        device = self.device
+        resample_method: Resampling = get_pil_resample_method(resample_method)
+        prev_latents, prev_shape = None, None
+
+        if show_progress_bar:
+            frames = tqdm(frames, desc="Video frames", leave=False)
+        for frame in frames:
+            input_size = frame.size
+            if processing_res > 0:
+                frame = self.resize_max_res(frame, max_edge_resolution=processing_res, resample_method=resample_method)
+            frame = frame.convert("RGB")
+            rgb_norm = self.rgb_to_device(np.asarray(frame), device=device, dtype=self.dtype)
+
+            if prev_latents is not None and prev_shape == rgb_norm.shape:
+                # Warm start from the previous frame
+                n_members = video_ensemble_size
+                depth_preds, latents = self.single_infer(
+                    rgb_in=rgb_norm.unsqueeze(0).repeat(n_members, 1, 1, 1),
+                    num_inference_steps=denoising_steps,
+                    seed=seed,
+                    show_pbar=False,
+                    frequency_scaling=frequency_scaling,
+                    depth_latent_init=prev_latents,
+                    strength=warm_start_strength,
+                    return_latent=True,
+                )
+            else:
+                # Cold start, from pure noise
+                n_members = ensemble_size
+                _bs = batch_size or self._plan_batch_size(ensemble_size, input_shape=tuple(rgb_norm.shape[1:]))
+                depth_preds, latents = [], []
+                for i in range(0, ensemble_size, _bs):
+                    depth_pred_raw, latent = self.single_infer(
+                        rgb_in=rgb_norm.unsqueeze(0).repeat(min(_bs, ensemble_size - i), 1, 1, 1),
+                        num_inference_steps=denoising_steps,
+                        seed=None if seed is None else seed + i,
+                        show_pbar=False,
+                        frequency_scaling=frequency_scaling,
+                        return_latent=True,
+                    )
+                    depth_preds.append(depth_pred_raw)
+                    latents.append(latent)
+                depth_preds = torch.concat(depth_preds, dim=0)
+                latents = torch.concat(latents, dim=0)
+            prev_latents, prev_shape = latents[:video_ensemble_size], rgb_norm.shape
+
+            if n_members > 1:
+                depth_pred, pred_uncert = self.ensemble_depths(depth_preds.squeeze(1), **(ensemble_kwargs or {}))
+            else:
+                depth_pred, pred_uncert = depth_preds.squeeze(), None
+
+            # Scale prediction to [0, 1]
+            min_d = torch.min(depth_pred)
+            max_d = torch.max(depth_pred)
+            depth_pred = (depth_pred - min_d) / (max_d - min_d)
+
+            yield self._postprocess_depth(
+                depth_pred=depth_pred.cpu().numpy().astype(np.float32),
+                pred_uncert=None if pred_uncert is None else pred_uncert.cpu().numpy().astype(np.float32),
+                ensemble_size=n_members,
+                input_size=input_size,
+                match_input_res=match_input_res,
+                resample_method=resample_method,
+                color_map=color_map,
+            )
+
+    def _iter_depth_batches(
+        self,
+        rgb_norm: torch.Tensor,
+        ensemble_size: int,
+        batch_size: int,
+        denoising_steps: int,
+        seed: Union[int, None],
+        show_progress_bar: bool,
+        frequency_scaling: bool = False,
+        worker_pool: Optional["MarigoldEnsembleWorkerPool"] = None,
+    ):
+        """
+        Predict the ensemble members in batches, yielding each batch as soon as it is decoded.
+
+        Args:
+            rgb_norm (`torch.Tensor`):
+                Normalized input RGB image, with the shape of [3, H, W].
+            ensemble_size (`int`):
+                Number of predictions to be generated.
+            batch_size (`int`):
+                Maximum number of predictions per batch.
+        Returns:
+            Iterator of `torch.Tensor`: Predicted depth maps, with the shape of [B, 1, H, W].
+        """
+        batch_sizes = [min(batch_size, ensemble_size - i) for i in range(0, ensemble_size, batch_size)]
+        if show_progress_bar:
+            iterable = tqdm(batch_sizes, desc=" " * 2 + "Inference batches", leave=False)
+        else:
+            iterable = batch_sizes
+        if worker_pool is not None:
+            # Encode the image once, workers share the latent
+            rgb_latent = self.encode_rgb(rgb_norm.unsqueeze(0))
+        for i, bs in enumerate(iterable):
+            if worker_pool is not None:
+                yield worker_pool.infer(
+                    rgb_latent,
+                    n_members=bs,
+                    num_inference_steps=denoising_steps,
+                    seed=None if seed is None else seed + i * batch_size,
+                    frequency_scaling=frequency_scaling,
+                )
+                continue
+            # Batch repeated input image
+            batched_img = rgb_norm.unsqueeze(0).repeat(bs, 1, 1, 1)
+            depth_pred_raw = self._backoff_single_infer(
+                rgb_in=batched_img,
+                num_inference_steps=denoising_steps,
+                show_pbar=show_progress_bar,
+                seed=None if seed is None else seed + i * batch_size,
+                frequency_scaling=frequency_scaling,
+            )
+            yield depth_pred_raw.detach()
+
+    def _tiled_infer(
+        self,
+        rgb_norm: torch.Tensor,
+        tile_size: int,
+        tile_overlap: int,
+        ensemble_size: int,
+        batch_size: int,
+        denoising_steps: int,
+        seed: Union[int, None],
+        show_progress_bar: bool,
+        frequency_scaling: bool = False,
+        ensemble_kwargs: Dict = None,
+        memory_budget: float = 0.9,
+    ):
+        """
+        Predict depth on overlapping tiles and stitch them into one affine-invariant depth map.
+
+        All (tile, ensemble member) pairs are batched through `single_infer`. Every tile is ensembled as soon as its
+        members are complete, aligned by least squares to the already stitched depth in the overlap region and
+        blended in with linear ramps.
+
+        Args:
+            rgb_norm (`torch.Tensor`):
+                Normalized input RGB image, with the shape of [3, H, W].
+            tile_size (`int`):
+                Edge length of the tiles (pixel).
+            tile_overlap (`int`):
+                Overlap between neighboring tiles (pixel).
+        Returns:
+            `Tuple[torch.Tensor, torch.Tensor]`: Stitched depth map scaled to [0, 1], and uncertainty (`None` if
+            `ensemble_size = 1`).
+        """
+        _, H, W = rgb_norm.shape
+        tile_h, tile_w = min(tile_size, H), min(tile_size, W)
+        # keep tiles aligned with the latent grid
+        tile_h, tile_w = max(8, tile_h - tile_h % 8), max(8, tile_w - tile_w % 8)
+        tile_coords = [
+            (y, x)
+            for y in self._tile_starts(H, tile_h, tile_overlap)
+            for x in self._tile_starts(W, tile_w, tile_overlap)
+        ]
+        tiles = torch.stack([rgb_norm[:, y : y + tile_h, x : x + tile_w] for y, x in tile_coords])
+
+        if batch_size > 0:
+            _bs = batch_size
+        else:
+            _bs = self._plan_batch_size(
+                ensemble_size=len(tile_coords) * ensemble_size,
+                input_shape=(tile_h, tile_w),
+                memory_budget=memory_budget,
+            )
+
+        blend_weight = self._tile_blend_weight(tile_h, tile_w, tile_overlap).to(rgb_norm.device)
+        depth_acc = torch.zeros((H, W), device=rgb_norm.device, dtype=torch.float32)
+        uncert_acc = torch.zeros_like(depth_acc) if ensemble_size > 1 else None
+        weight_acc = torch.zeros_like(depth_acc)
+
+        # tile-major order, so that tiles complete one after another
+        tile_idx = torch.arange(len(tile_coords)).repeat_interleave(ensemble_size)
+        chunks = tile_idx.split(_bs)
+        if show_progress_bar:
+            chunks = tqdm(chunks, desc=" " * 2 + "Inference tiles", leave=False)
+
+        pending = []
+        next_tile = 0
+        for i, chunk in enumerate(chunks):
+            depth_pred_raw = self._backoff_single_infer(
+                rgb_in=tiles[chunk],
+                num_inference_steps=denoising_steps,
+                show_pbar=show_progress_bar,
+                seed=None if seed is None else seed + i * _bs,
+                frequency_scaling=frequency_scaling,
+            )
+            pending.extend(depth_pred_raw.detach().squeeze(1))
+
+            while len(pending) >= ensemble_size:
+                tile_preds, pending = torch.stack(pending[:ensemble_size]), pending[ensemble_size:]
+                if ensemble_size > 1:
+                    tile_depth, tile_uncert = self.ensemble_depths(tile_preds, **(ensemble_kwargs or {}))
+                else:
+                    tile_depth, tile_uncert = tile_preds[0], None
+                tile_depth = tile_depth.to(torch.float32)
+
+                y, x = tile_coords[next_tile]
+                next_tile += 1
+                region = (slice(y, y + tile_h), slice(x, x + tile_w))
+
+                # align to the already stitched depth in the overlap (least-squares scale and shift)
+                covered = weight_acc[region] > 0
+                scale = 1.0
+                if covered.any():
+                    src = tile_depth[covered]
+                    dst = depth_acc[region][covered] / weight_acc[region][covered]
+                    src_centered = src - src.mean()
+                    scale = (src_centered * (dst - dst.mean())).sum() / (src_centered**2).sum().clamp_min(1e-12)
+                    tile_depth = scale * (tile_depth - src.mean()) + dst.mean()
+
+                depth_acc[region] += blend_weight * tile_depth
+                weight_acc[region] += blend_weight
+                if uncert_acc is not None:
+                    uncert_acc[region] += blend_weight * tile_uncert.to(torch.float32) * abs(scale)
+
+        depth_pred = depth_acc / weight_acc
+        _min = torch.min(depth_pred)
+        _max = torch.max(depth_pred)
+        depth_pred = (depth_pred - _min) / (_max - _min)
+        if uncert_acc is not None:
+            pred_uncert = uncert_acc / weight_acc / (_max - _min)
+        else:
+            pred_uncert = None
+        return depth_pred, pred_uncert
+
+    @staticmethod
+    def _tile_starts(length: int, tile: int, overlap: int):
+        """
+        Start offsets of tiles of size `tile` covering `length`, with at least `overlap` between neighbors.
+        """
+        if length <= tile:
+            return [0]
+        stride = max(8, tile - overlap)
+        starts = list(range(0, length - tile, stride))
+        starts.append(length - tile)
+        return starts
+
+    @staticmethod
+    def _tile_blend_weight(tile_h: int, tile_w: int, overlap: int) -> torch.Tensor:
+        """
+        Blending weights of a tile, ramping up linearly over `overlap` pixels from each border.
+        """
+        overlap = max(1, overlap)
+
+        def ramp(n):
+            i = torch.arange(n, dtype=torch.float32)
+            return torch.minimum(torch.minimum(i + 1, n - i), torch.tensor(float(overlap))) / overlap
+
+        return ramp(tile_h)[:, None] * ramp(tile_w)[None, :]
+
+    def _adaptive_ensemble(
+        self,
+        depth_batches,
+        tol: float,
+        streaming_ensemble: bool = False,
+        ensemble_kwargs: Dict = None,
+    ):
+        """
+        Consume ensemble batches until the standard error of the ensembled prediction falls to `tol`.
+
+        New members are aligned to the running estimate with `MarigoldStreamingEnsemble`, so that each batch only
+        costs a closed-form fit. Without `streaming_ensemble`, all members are ensembled once with `ensemble_depths`
+        after the last batch.
+
+        Args:
+            depth_batches (`Iterator[torch.Tensor]`):
+                Batches of depth predictions, see `_iter_depth_batches`.
+            tol (`float`):
+                Mean per-pixel standard error (std / sqrt(n)), relative to the depth range, at which no further
+                batches are consumed.
+            streaming_ensemble (`bool`, *optional*, defaults to `False`):
+                Return the streaming ensemble instead of ensembling all members with `ensemble_depths`.
+            ensemble_kwargs (`dict`, *optional*, defaults to `None`):
+                Arguments for `ensemble_depths`.
+        Returns:
+            `Tuple[torch.Tensor, torch.Tensor, int]`: Ensembled depth map, uncertainty and the number of ensemble
+            members used.
+        """
+        ensemble = MarigoldStreamingEnsemble()
+        depth_pred_ls = []
+        for depth_pred_raw in depth_batches:
+            ensemble.update(depth_pred_raw)
+            if not streaming_ensemble:
+                depth_pred_ls.append(depth_pred_raw)
+            if ensemble.count < 2:
+                continue
+            _, pred_uncert = ensemble.finalize()
+            if pred_uncert.mean().item() / math.sqrt(ensemble.count) <= tol:
+                break
+
+        if streaming_ensemble or ensemble.count < 2:
+            depth_pred, pred_uncert = ensemble.finalize()
+        else:
+            depth_preds = torch.concat(depth_pred_ls, dim=0).squeeze(1)
+            depth_pred, pred_uncert = self.ensemble_depths(depth_preds, **(ensemble_kwargs or {}))
+        return depth_pred, pred_uncert, ensemble.count
+
     def _check_inference_step(self, n_step: int):
         """
         Check if denoising step is reasonable
@@ -352,27 +1335,50 @@ class MarigoldPipeline(DiffusionPipeline):
     def _encode_empty_text(self):
         """
         Encode text embedding for empty prompt.
+
+        The text encoder and the tokenizer are loaded on demand if the pipeline was created without them, and
+        released again afterwards.
         """
+        tokenizer, text_encoder = self.tokenizer, self.text_encoder
+        if tokenizer is None or text_encoder is None:
+            model_name = self.config.get("_name_or_path")
+            if not model_name:
+                raise ValueError(
+                    "The pipeline has no text encoder or tokenizer, and no `_name_or_path` to load them from. Pass "
+                    "`tokenizer` and `text_encoder`, load the pipeline with `from_pretrained`, or set "
+                    "`pipe.empty_text_embed`."
+                )
+        if tokenizer is None:
+            tokenizer = CLIPTokenizer.from_pretrained(model_name, subfolder="tokenizer")
+        if text_encoder is None:
+            text_encoder = CLIPTextModel.from_pretrained(
+                model_name, subfolder="text_encoder", torch_dtype=self.dtype
+            ).to(self.device)
+
         prompt = ""
-        text_inputs = self.tokenizer(
+        text_inputs = tokenizer(
             prompt,
             padding="do_not_pad",
-            max_length=self.tokenizer.model_max_length,
+            max_length=tokenizer.model_max_length,
             truncation=True,
             return_tensors="pt",
         )
-        text_input_ids = text_inputs.input_ids.to(self.text_encoder.device)
-        self.empty_text_embed = self.text_encoder(text_input_ids)[0].to(self.dtype)
+        text_input_ids = text_inputs.input_ids.to(text_encoder.device)
+        self.empty_text_embed = text_encoder(text_input_ids)[0].to(self.dtype)
 
     @torch.no_grad()
     def single_infer(
         self,
-        rgb_in: torch.Tensor,
+        rgb_in: Union[None, torch.Tensor],
         num_inference_steps: int,
         seed: Union[int, None],
         show_pbar: bool,
         frequency_scaling: bool = False,
-    ) -> torch.Tensor:
+        depth_latent_init: Optional[torch.Tensor] = None,
+        strength: float = 1.0,
+        return_latent: bool = False,
+        rgb_latent: Optional[torch.Tensor] = None,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
         """
         Perform an individual depth prediction without ensembling.
 
@@ -381,36 +1387,58 @@ class MarigoldPipeline(DiffusionPipeline):
                 Input RGB image.
             num_inference_steps (`int`):
                 Number of diffusion denoisign steps (DDIM) during inference.
+            seed (`int`, *optional*):
+                Seed of the first prediction in the batch, prediction `k` is seeded with `seed + k`.
             show_pbar (`bool`):
                 Display a progress bar of diffusion denoising.
+            depth_latent_init (`torch.Tensor`, *optional*):
+                Depth latent to start from instead of pure noise, e.g. the latent of the previous video frame. It is
+                noised to the timestep given by `strength` and only the remaining steps are run.
+            strength (`float`, *optional*, defaults to `1.0`):
+                Fraction of the `num_inference_steps` steps to run when starting from `depth_latent_init`.
+            return_latent (`bool`, *optional*, defaults to `False`):
+                Also return the final depth latent.
+            rgb_latent (`torch.Tensor`, *optional*):
+                Already encoded RGB latent, used instead of encoding `rgb_in` (which may then be `None`).
         Returns:
-            `torch.Tensor`: Predicted depth map.
+            `torch.Tensor`: Predicted depth map, and the depth latent if `return_latent`.
         """
-        device = rgb_in.device
+        device = rgb_in.device if rgb_latent is None else rgb_latent.device
 
         # Set timesteps
         self.scheduler.set_timesteps(num_inference_steps, device=device)
         timesteps = self.scheduler.timesteps  # [T]
+        if depth_latent_init is not None:
+            n_steps = min(max(int(round(num_inference_steps * strength)), 1), num_inference_steps)
+            timesteps = timesteps[num_inference_steps - n_steps :]
 
         # Encode image
-        rgb_latent = self.encode_rgb(rgb_in)
+        if rgb_latent is None:
+            rgb_latent = self.encode_rgb(rgb_in)
 
         # Initial depth map (noise)
         if seed is None:
             rand_num_generator = None
         else:
-            rand_num_generator = torch.Generator(device=device)
-            rand_num_generator.manual_seed(seed)
-        depth_latent = torch.randn(
+            # one generator per member, so that the noise does not depend on the batching
+            rand_num_generator = [
+                torch.Generator(device=device).manual_seed(seed + k) for k in range(rgb_latent.shape[0])
+            ]
+        depth_latent = randn_tensor(
             rgb_latent.shape,
+            generator=rand_num_generator,
             device=device,
             dtype=self.dtype,
-            generator=rand_num_generator,
         )  # [B, 4, h, w]
+        if depth_latent_init is not None:
+            # Warm start: noise the given latent to the first remaining timestep
+            depth_latent_init = depth_latent_init.to(device=device, dtype=self.dtype).expand_as(depth_latent)
+            depth_latent = self.scheduler.add_noise(depth_latent_init, depth_latent, timesteps[:1])
 
         # Batched empty text embedding
         if self.empty_text_embed is None:
             self._encode_empty_text()
+        self.empty_text_embed = self.empty_text_embed.to(device=device, dtype=self.dtype)
         batch_empty_text_embed = self.empty_text_embed.repeat((rgb_latent.shape[0], 1, 1))  # [B, 2, 1024]
 
         # Denoising loop
@@ -424,18 +1452,29 @@ class MarigoldPipeline(DiffusionPipeline):
         else:
             iterable = enumerate(timesteps)
 
-        for i, t in iterable:
-            unet_input = torch.cat([rgb_latent, depth_latent], dim=1)  # this order is important
+        # UNet input buffer, the RGB half is written once and the depth half is updated in place
+        n_rgb = rgb_latent.shape[1]
+        unet_input = torch.empty(
+            (rgb_latent.shape[0], n_rgb + depth_latent.shape[1], *rgb_latent.shape[2:]), device=device, dtype=self.dtype
+        )
+        unet_input[:, :n_rgb] = rgb_latent  # this order is important
+        unet_input[:, n_rgb:] = depth_latent
+        depth_latent = unet_input[:, n_rgb:]
+        if frequency_scaling:
+            fourier_filter = FourierFilterWorkspace(1, 2, 20)
 
+        for i, t in iterable:
             # predict the noise residual
             noise_pred = self.unet(unet_input, t, encoder_hidden_states=batch_empty_text_embed).sample  # [B, 4, h, w]
 
             if frequency_scaling:
                 # Our Frequency-dependent scaling
-                noise_pred = Fourier_filter(noise_pred,1,2,20)
+                noise_pred = fourier_filter(noise_pred, out=noise_pred)
 
             # compute the previous noisy sample x_t -> x_t-1
-            depth_latent = self.scheduler.step(noise_pred, t, depth_latent, generator=rand_num_generator).prev_sample
+            depth_latent.copy_(
+                self.scheduler.step(noise_pred, t, depth_latent, generator=rand_num_generator).prev_sample
+            )
 
         depth = self.decode_depth(depth_latent)
 
@@ -444,6 +1483,8 @@ class MarigoldPipeline(DiffusionPipeline):
         # shift to [0, 1]
         depth = (depth + 1.0) / 2.0
 
+        if return_latent:
+            return depth, depth_latent.clone()
         return depth
 
     def encode_rgb(self, rgb_in: torch.Tensor) -> torch.Tensor:
@@ -526,6 +1567,8 @@ class MarigoldPipeline(DiffusionPipeline):
             depth = depth[np.newaxis, :, :]
 
         # colorize
+        import matplotlib
+
         cm = matplotlib.colormaps[cmap]
         depth = ((depth - min_depth) / (max_depth - min_depth)).clip(0, 1)
         img_colored_np = cm(depth, bytes=False)[:, :, :, 0:3]  # value from 0 to 1
@@ -549,6 +1592,109 @@ class MarigoldPipeline(DiffusionPipeline):
 
         return img_colored
 
+    @staticmethod
+    def colorize_depth_lut(depth_map, cmap="Spectral", min_depth=0.0, max_depth=1.0, lut_size=256, out=None):
+        """
+        Colorize depth maps with a single gather from a cached uint8 colormap lookup table.
+
+        With the default `lut_size=256` the result is identical to `colorize_depth_maps` quantized to uint8, without
+        the intermediate float RGBA and CHW copies.
+
+        Args:
+            depth_map (`np.ndarray` or `torch.Tensor`):
+                Depth map(s), with the shape of [(B,) H, W]. Tensors are colorized on their own device.
+            cmap (`str`, *optional*, defaults to `"Spectral"`):
+                Matplotlib colormap name.
+            min_depth (`float`), max_depth (`float`):
+                Depth values mapped to the ends of the colormap.
+            lut_size (`int`, *optional*, defaults to `256`):
+                Number of entries of the lookup table, e.g. 65536 for a smoother gradient.
+            out (`np.ndarray`, *optional*):
+                uint8 buffer with the shape of [(B,) H, W, 3] to write into (numpy input only).
+
+        Returns:
+            `np.ndarray` or `torch.Tensor`: Colorized depth map(s), with the shape of [(B,) H, W, 3] and dtype uint8.
+        """
+        if isinstance(depth_map, torch.Tensor):
+            lut = _colormap_lut_tensor(cmap, lut_size, depth_map.device)
+            depth = ((depth_map - min_depth) / (max_depth - min_depth)).clip(0, 1)
+            # NaN, e.g. of a constant prediction, takes the "bad" color
+            idx = (depth.nan_to_num(0.0) * lut_size).long().clamp_(max=lut_size - 1)
+            idx = torch.where(depth.isnan(), lut_size, idx)
+            return lut[idx]
+
+        lut = _colormap_lut(cmap, lut_size)
+        depth = ((depth_map - min_depth) / (max_depth - min_depth)).clip(0, 1)
+        nan_mask = np.isnan(depth)
+        idx = (np.nan_to_num(depth, nan=0.0) * lut_size).astype(np.intp)
+        np.minimum(idx, lut_size - 1, out=idx)
+        idx[nan_mask] = lut_size
+        return np.take(lut, idx, axis=0, out=out)
+
+    @staticmethod
+    def postprocess_depth_device(
+        depth: torch.Tensor,
+        output_size: Optional[Tuple[int, int]] = None,
+        resample_method: Resampling = Resampling.BILINEAR,
+        color_map: Union[None, str] = None,
+        output_uint16: bool = False,
+    ) -> Tuple[np.ndarray, Union[None, np.ndarray]]:
+        """
+        Normalize, resize, clip, quantize and colorize depth predictions on their device, in one pass.
+
+        Args:
+            depth (`torch.Tensor`):
+                Depth prediction(s), with the shape of [(B,) H, W]. Every prediction is min-max normalized to [0, 1].
+            output_size (`Tuple[int, int]`, *optional*):
+                Output size (W, H) as in PIL, defaults to the prediction size.
+            resample_method (`Resampling`, *optional*, defaults to `Resampling.BILINEAR`):
+                Bilinear and bicubic resizing are antialiased like PIL, nearest uses pixel centers like PIL.
+            color_map (`str`, *optional*):
+                Colormap to colorize with, see `colorize_depth_lut`.
+            output_uint16 (`bool`, *optional*, defaults to `False`):
+                Quantize the depth to uint16 instead of returning float32.
+
+        Returns:
+            `Tuple[np.ndarray, Union[None, np.ndarray]]`: Depth map(s) with the shape of [(B,) H, W], and colorized
+            depth map(s) with the shape of [(B,) H, W, 3] and dtype uint8, or `None` without `color_map`.
+        """
+        squeeze = depth.dim() == 2
+        depth = depth.reshape(-1, 1, *depth.shape[-2:]).float()
+
+        # Scale predictions to [0, 1]
+        min_d = depth.amin(dim=(-2, -1), keepdim=True)
+        max_d = depth.amax(dim=(-2, -1), keepdim=True)
+        depth = (depth - min_d) / (max_d - min_d)
+
+        # Resize, clip
+        if output_size is not None and tuple(output_size) != (depth.shape[-1], depth.shape[-2]):
+            size = (output_size[1], output_size[0])
+            if resample_method == Resampling.NEAREST:
+                depth = F.interpolate(depth, size=size, mode="nearest-exact")
+            else:
+                mode = "bicubic" if resample_method == Resampling.BICUBIC else "bilinear"
+                depth = F.interpolate(depth, size=size, mode=mode, align_corners=False, antialias=True)
+        depth = depth[:, 0].clamp_(0, 1)
+
+        depth_colored = None
+        if color_map is not None:
+            depth_colored = MarigoldPipeline.colorize_depth_lut(depth, cmap=color_map)
+        if output_uint16:
+            depth = depth.mul_(65535.0).round_().to(torch.int32)
+            if hasattr(torch, "uint16"):
+                depth = depth.to(torch.uint16)
+
+        if squeeze:
+            depth = depth[0]
+            depth_colored = None if depth_colored is None else depth_colored[0]
+        depth = depth.cpu().numpy()
+        if output_uint16 and depth.dtype != np.uint16:
+            # torch < 2.3 has no uint16, narrow on the host instead
+            depth = depth.astype(np.uint16)
+        if depth_colored is not None:
+            depth_colored = depth_colored.cpu().numpy()
+        return depth, depth_colored
+
     @staticmethod
     def chw2hwc(chw):
         assert 3 == len(chw.shape)
@@ -558,6 +1704,168 @@ class MarigoldPipeline(DiffusionPipeline):
             hwc = np.moveaxis(chw, 0, -1)
         return hwc
 
+    def _backoff_single_infer(self, rgb_in: torch.Tensor, **kwargs) -> torch.Tensor:
+        """
+        Run `single_infer`, splitting the batch in halves on out-of-memory errors. The seeds of the split batches
+        are offset, so that every prediction keeps its noise.
+
+        The reduced batch size is kept for the resolution bucket for later calls of this pipeline, but not persisted,
+        as the error may have been caused by another process holding memory at the time.
+        """
+        key = self._batch_plan_key(tuple(rgb_in.shape[-2:]))
+        max_bs = self._oom_batch_limits.get(key)
+        if max_bs is not None and rgb_in.shape[0] > max_bs:
+            seed = kwargs.pop("seed", None)
+            return torch.concat(
+                [
+                    self._backoff_single_infer(
+                        chunk, seed=None if seed is None else seed + i * max_bs, **kwargs
+                    )
+                    for i, chunk in enumerate(rgb_in.split(max_bs))
+                ]
+            )
+
+        try:
+            return self.single_infer(rgb_in, **kwargs)
+        except torch.cuda.OutOfMemoryError:
+            if rgb_in.shape[0] == 1:
+                raise
+            torch.cuda.empty_cache()
+            max_bs = rgb_in.shape[0] // 2
+            logging.warning(f"Out of memory with batch size {rgb_in.shape[0]}, retrying with {max_bs}.")
+            self._oom_batch_limits[key] = max_bs
+            return self._backoff_single_infer(rgb_in, **kwargs)
+
+    def _plan_batch_size(self, ensemble_size: int, input_shape: Tuple[int, int], memory_budget: float = 0.9) -> int:
+        """
+        Choose the operating batch size from the measured memory footprint of `single_infer`.
+
+        The fixed and per-sample peak memory of one denoising step are measured once per (resolution bucket, dtype,
+        device) and cached on disk, see `batch_plan_cache_path`. A bucket is a square of `batch_plan_bucket`
+        multiples covering the pixel count of the input, and is measured at that size. Falls back to
+        `_find_batch_size` if memory cannot be measured.
+
+        Args:
+            ensemble_size (`int`):
+                Number of predictions to be ensembled.
+            input_shape (`Tuple[int, int]`):
+                Operating resolution (H, W) of the input image.
+            memory_budget (`float`, *optional*, defaults to `0.9`):
+                Fraction of the currently free memory to plan for.
+
+        Returns:
+            `int`: Operating batch size.
+        """
+        if ensemble_size <= 1:
+            return 1
+        key = self._batch_plan_key(input_shape)
+        plan = self._load_batch_plans().get(key, {})
+        if "per_sample" not in plan:
+            edge = self._batch_plan_edge(input_shape)
+            try:
+                peak_1 = self._measure_peak_memory((edge, edge), batch_size=1)
+                try:
+                    peak_2 = self._measure_peak_memory((edge, edge), batch_size=2)
+                except torch.cuda.OutOfMemoryError:
+                    torch.cuda.empty_cache()
+                    peak_2 = 2 * peak_1
+            except RuntimeError as e:
+                logging.warning(f"Could not measure memory footprint ({e}), using the batch size table.")
+                return self._find_batch_size(ensemble_size, max(input_shape), self.dtype)
+            if peak_1 <= 0 or peak_2 <= 0:
+                # e.g. the lifetime maximum RSS used without psutil did not grow, nothing to plan with
+                logging.warning("Could not measure memory footprint, using the batch size table.")
+                return self._find_batch_size(ensemble_size, max(input_shape), self.dtype)
+            per_sample = peak_2 - peak_1 if peak_2 > peak_1 else peak_1
+            plan = self._update_batch_plan(key, per_sample=per_sample, fixed=max(peak_1 - per_sample, 0))
+
+        bs = int((self._available_memory() * memory_budget - plan["fixed"]) // max(plan["per_sample"], 1))
+        if key in self._oom_batch_limits:
+            bs = min(bs, self._oom_batch_limits[key])
+        return self._balance_batch_size(max(bs, 1), ensemble_size)
+
+    def _measure_peak_memory(self, input_shape: Tuple[int, int], batch_size: int) -> int:
+        """
+        Peak memory (bytes) allocated by one denoising step of `single_infer`, on top of the current usage.
+        """
+        device = self.device
+        rgb_in = torch.zeros((batch_size, 3, *input_shape), device=device, dtype=self.dtype)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device)
+            self.single_infer(rgb_in, num_inference_steps=1, seed=0, show_pbar=False)
+            torch.cuda.synchronize(device)
+            return torch.cuda.max_memory_allocated(device) - baseline
+
+        with _PeakRSSMonitor() as monitor:
+            self.single_infer(rgb_in, num_inference_steps=1, seed=0, show_pbar=False)
+        return monitor.peak - monitor.baseline
+
+    def _available_memory(self) -> int:
+        """
+        Currently free device memory (bytes), or available host memory when not running on CUDA.
+        """
+        if self.device.type == "cuda":
+            return torch.cuda.mem_get_info(self.device)[0]
+        if psutil is not None:
+            return psutil.virtual_memory().available
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+    @classmethod
+    def _batch_plan_edge(cls, input_shape: Tuple[int, int]) -> int:
+        """
+        Edge length of the square resolution bucket holding at least as many pixels as `input_shape`.
+        """
+        edge = math.sqrt(input_shape[0] * input_shape[1])
+        return max(1, math.ceil(edge / cls.batch_plan_bucket)) * cls.batch_plan_bucket
+
+    def _batch_plan_key(self, input_shape: Tuple[int, int]) -> str:
+        device = self.device
+        if device.type == "cuda":
+            device_name = torch.cuda.get_device_name(device)
+        else:
+            device_name = device.type
+        edge = self._batch_plan_edge(input_shape)
+        return f"{edge}x{edge}|{self.dtype}|{device_name}"
+
+    @classmethod
+    def _load_batch_plans(cls) -> Dict:
+        if cls._batch_plans is None:
+            try:
+                with open(cls.batch_plan_cache_path) as f:
+                    cls._batch_plans = json.load(f)
+            except (OSError, ValueError):
+                cls._batch_plans = {}
+        return cls._batch_plans
+
+    @classmethod
+    def _update_batch_plan(cls, key: str, **plan) -> Dict:
+        plans = cls._load_batch_plans()
+        plans[key] = {**plans.pop(key, {}), **plan}
+        for old_key in list(plans)[: max(0, len(plans) - cls.max_batch_plans)]:
+            del plans[old_key]
+        try:
+            os.makedirs(os.path.dirname(cls.batch_plan_cache_path), exist_ok=True)
+            tmp_path = f"{cls.batch_plan_cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(plans, f, indent=2)
+            os.replace(tmp_path, cls.batch_plan_cache_path)
+        except OSError as e:
+            logging.warning(f"Could not persist batch size plan: {e}")
+        return plans[key]
+
+    @staticmethod
+    def _balance_batch_size(bs: int, ensemble_size: int) -> int:
+        """
+        Limit the batch size to the ensemble size, and split the ensemble into batches of similar size.
+        """
+        if bs > ensemble_size:
+            bs = ensemble_size
+        elif bs > math.ceil(ensemble_size / 2) and bs < ensemble_size:
+            bs = math.ceil(ensemble_size / 2)
+        return bs
+
     @staticmethod
     def _find_batch_size(ensemble_size: int, input_res: int, dtype: torch.dtype) -> int:
         """
@@ -607,12 +1915,7 @@ class MarigoldPipeline(DiffusionPipeline):
             key=lambda k: (k["res"], -k["total_vram"]),
         ):
             if input_res <= settings["res"] and total_vram >= settings["total_vram"]:
-                bs = settings["bs"]
-                if bs > ensemble_size:
-                    bs = ensemble_size
-                elif bs > math.ceil(ensemble_size / 2) and bs < ensemble_size:
-                    bs = math.ceil(ensemble_size / 2)
-                return bs
+                return MarigoldPipeline._balance_batch_size(settings["bs"], ensemble_size)
 
         return 1
 
@@ -728,61 +2031,580 @@ class MarigoldPipeline(DiffusionPipeline):
 
         return aligned_images, uncertainty
 
-import numpy as np
-import torch
-from PIL import Image
-from diffusers import DiffusionPipeline
-from diffusers.utils import load_image
-
-# Original DDIM version (higher quality)
-pipe = MarigoldPipeline.from_pretrained(
-    "prs-eth/marigold-v1-0",
-    # custom_pipeline="marigold_depth_estimation"
-    # torch_dtype=torch.float16,                # (optional) Run with half-precision (16-bit float).
-    # variant="fp16",                           # (optional) Use with `torch_dtype=torch.float16`, to directly load fp16 checkpoint
-)
 
-# # (New) LCM version (faster speed)
-# pipe = MarigoldPipeline.from_pretrained(
-#     "prs-eth/marigold-depth-lcm-v1-0",
-    # cache_dir="/home/cxu-serve/p62/chuang65/checkpoints",
-#     # custom_pipeline="marigold_depth_estimation"
-#     # torch_dtype=torch.float16,                # (optional) Run with half-precision (16-bit float).
-#     # variant="fp16",                           # (optional) Use with `torch_dtype=torch.float16`, to directly load fp16 checkpoint
-# )
-
-pipe.to("cuda")
-
-img_path_or_url = "https://share.phys.ethz.ch/~pf/bingkedata/marigold/pipeline_example.jpg"
-image: Image.Image = load_image(img_path_or_url)
-
-pipeline_output = pipe(
-    image,                    # Input image.
-    freqyency_scaling=True,   # Apply frequency-dependent scaling to the noise prediction.
-    # ----- recommended setting for DDIM version -----
-    # denoising_steps=10,     # (optional) Number of denoising steps of each inference pass. Default: 10.
-    # ensemble_size=10,       # (optional) Number of inference passes in the ensemble. Default: 10.
-    # ------------------------------------------------
-
-    # ----- recommended setting for LCM version ------
-    # denoising_steps=4,
-    # ensemble_size=5,
-    # -------------------------------------------------
-
-    # processing_res=768,     # (optional) Maximum resolution of processing. If set to 0: will not resize at all. Defaults to 768.
-    # match_input_res=True,   # (optional) Resize depth prediction to match input resolution.
-    # batch_size=0,           # (optional) Inference batch size, no bigger than `num_ensemble`. If set to 0, the script will automatically decide the proper batch size. Defaults to 0.
-    # seed=2024,              # (optional) Random seed can be set to ensure additional reproducibility. Default: None (unseeded). Note: forcing --batch_size 1 helps to increase reproducibility. To ensure full reproducibility, deterministic mode needs to be used.
-    # color_map="Spectral",   # (optional) Colormap used to colorize the depth map. Defaults to "Spectral". Set to `None` to skip colormap generation.
-    # show_progress_bar=True, # (optional) If true, will show progress bars of the inference progress.
-)
+def _ensemble_worker(
+    rank, unet, vae, scheduler_cls, scheduler_config, empty_text_embed, num_threads, task_queue, done_queue
+):
+    """
+    Loop of a `MarigoldEnsembleWorkerPool` process. The modules arrive with their weights in shared memory.
+    """
+    torch.set_num_threads(num_threads)
+    pipe = MarigoldPipeline(unet=unet, vae=vae, scheduler=scheduler_cls.from_config(scheduler_config))
+    pipe.empty_text_embed = empty_text_embed
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        rgb_latent, out, start, stop, kwargs = task
+        try:
+            out[start:stop] = pipe.single_infer(
+                None, rgb_latent=rgb_latent.expand(stop - start, -1, -1, -1), show_pbar=False, **kwargs
+            )
+            done_queue.put((rank, None))
+        except Exception as e:
+            done_queue.put((rank, f"{type(e).__name__}: {e}"))
+
+
+class MarigoldEnsembleWorkerPool:
+    """
+    Pool of worker processes that shard the ensemble members of one image, for CPU-only deployments where a
+    single process cannot keep all cores busy at small batch sizes.
+
+    The UNet and VAE weights are moved to shared memory once and mapped by all workers. Per image, the parent
+    encodes the RGB latent once into shared memory, every worker denoises and decodes a slice of the ensemble, and
+    writes its depth maps into a shared output buffer that is then ensembled as usual.
+
+    Example:
+        ```py
+        >>> with MarigoldEnsembleWorkerPool(pipe, num_workers=4) as pool:
+        ...     output = pipe(image, ensemble_size=8, worker_pool=pool)
+        ```
+
+    Args:
+        pipe (`MarigoldPipeline`):
+            Pipeline on the CPU, with its empty text embedding encoded or loaded.
+        num_workers (`int`, *optional*):
+            Number of worker processes, defaults to the number of cores divided by `num_threads`.
+        num_threads (`int`, *optional*):
+            Intra-op threads per worker, defaults to the number of cores divided by `num_workers`, at least 1.
+        poll_interval (`float`, *optional*, defaults to 1.0):
+            Seconds between checks for dead workers while waiting for results.
+    """
+
+    def __init__(
+        self,
+        pipe: "MarigoldPipeline",
+        num_workers: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        poll_interval: float = 1.0,
+    ):
+        import torch.multiprocessing as mp
+
+        if pipe.device.type != "cpu":
+            raise ValueError(f"Ensemble worker pools run on the CPU, got a pipeline on {pipe.device}.")
+        n_cores = os.cpu_count() or 1
+        if num_workers is None:
+            num_workers = max(1, n_cores // (num_threads or 2))
+        self.num_workers = num_workers
+        self.num_threads = num_threads or max(1, n_cores // num_workers)
+        self.poll_interval = poll_interval
+        self.dtype = pipe.dtype
+        self.vae_scale_factor = 2 ** (len(pipe.vae.config.block_out_channels) - 1)
+
+        if pipe.empty_text_embed is None:
+            pipe._encode_empty_text()
+        pipe.unet.share_memory()
+        pipe.vae.share_memory()
+        empty_text_embed = pipe.empty_text_embed.share_memory_()
+
+        ctx = mp.get_context("spawn")
+        self._task_queue = ctx.Queue()
+        self._done_queue = ctx.Queue()
+        self._workers = [
+            ctx.Process(
+                target=_ensemble_worker,
+                args=(
+                    rank,
+                    pipe.unet,
+                    pipe.vae,
+                    type(pipe.scheduler),
+                    dict(pipe.scheduler.config),
+                    empty_text_embed,
+                    self.num_threads,
+                    self._task_queue,
+                    self._done_queue,
+                ),
+                daemon=True,
+            )
+            for rank in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def infer(
+        self,
+        rgb_latent: torch.Tensor,
+        n_members: int,
+        num_inference_steps: int,
+        seed: Union[int, None],
+        frequency_scaling: bool = False,
+    ) -> torch.Tensor:
+        """
+        Predict `n_members` depth maps from one encoded RGB latent, sharded across the workers.
+
+        Args:
+            rgb_latent (`torch.Tensor`):
+                RGB latent, with the shape of [1, 4, h, w].
+            seed (`int`, *optional*):
+                Seed of the first member, member `k` is seeded with `seed + k` as in `MarigoldPipeline.single_infer`.
 
-depth: np.ndarray = pipeline_output.depth_np                    # Predicted depth map
-depth_colored: Image.Image = pipeline_output.depth_colored      # Colorized prediction
+        Returns:
+            `torch.Tensor`: Predicted depth maps, with the shape of [n_members, 1, H, W].
+        """
+        rgb_latent = rgb_latent.detach().to(self.dtype).contiguous().share_memory_()
+        h, w = rgb_latent.shape[-2:]
+        out = torch.empty((n_members, 1, h * self.vae_scale_factor, w * self.vae_scale_factor), dtype=self.dtype)
+        out.share_memory_()
+
+        n_shards = min(self.num_workers, n_members)
+        bounds = [round(i * n_members / n_shards) for i in range(n_shards + 1)]
+        for i in range(n_shards):
+            kwargs = dict(
+                num_inference_steps=num_inference_steps,
+                seed=None if seed is None else seed + bounds[i],
+                frequency_scaling=frequency_scaling,
+            )
+            self._task_queue.put((rgb_latent, out, bounds[i], bounds[i + 1], kwargs))
+
+        errors = []
+        n_done = 0
+        while n_done < n_shards:
+            try:
+                rank, error = self._done_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                # a worker killed by the OS, e.g. out of memory, never reports back
+                dead = [
+                    f"worker {rank} (exit code {worker.exitcode})"
+                    for rank, worker in enumerate(self._workers)
+                    if not worker.is_alive()
+                ]
+                if dead:
+                    raise RuntimeError("Ensemble workers died: " + ", ".join(dead))
+                continue
+            n_done += 1
+            if error is not None:
+                errors.append(f"worker {rank}: {error}")
+        if errors:
+            raise RuntimeError("Ensemble workers failed: " + "; ".join(errors))
+        return out
+
+    def close(self):
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _export_depth_files(
+    output_dir: str,
+    name: str,
+    depth_np: np.ndarray,
+    uncertainty: Union[None, np.ndarray],
+    depth_colored: Union[None, np.ndarray],
+    formats: Sequence[str],
+):
+    """
+    Encode and write one prediction, see `MarigoldDepthExporter`. Runs in an encoder process.
 
-# Save as uint16 PNG
-depth_uint16 = (depth * 65535.0).astype(np.uint16)
-Image.fromarray(depth_uint16).save("./depth_map.png", mode="I;16")
+    Every file is written to a temporary name first and renamed, so interrupted jobs never leave partial files.
+    """
+    base = os.path.join(output_dir, name)
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+
+    def write(path, save_fn):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            save_fn(f)
+        os.replace(tmp_path, path)
+        return path
+
+    files = []
+    for fmt in formats:
+        if fmt == "png16":
+            depth_u16 = depth_np
+            if depth_u16.dtype != np.uint16:
+                depth_u16 = (depth_u16 * 65535.0).round().astype(np.uint16)
+            depth_img = Image.fromarray(depth_u16)
+            files.append(write(f"{base}_depth.png", lambda f: depth_img.save(f, format="PNG")))
+        elif fmt == "npy":
+            files.append(write(f"{base}_depth.npy", lambda f: np.save(f, depth_np)))
+        elif fmt == "npz":
+            arrays = {"depth": depth_np}
+            if uncertainty is not None:
+                arrays["uncertainty"] = uncertainty
+            files.append(write(f"{base}_depth.npz", lambda f: np.savez_compressed(f, **arrays)))
+        else:
+            raise ValueError(f"Unknown export format: {fmt}")
+    if depth_colored is not None:
+        colored_img = Image.fromarray(depth_colored)
+        files.append(write(f"{base}_colored.png", lambda f: colored_img.save(f, format="PNG")))
+    return files
+
+
+class MarigoldDepthExporter:
+    """
+    Bulk writer for Marigold predictions, encoding 16-bit PNG, NPY or compressed NPZ files in a process pool.
+
+    At most `max_in_flight` predictions are queued for encoding at any time; `submit` blocks until a slot is free.
+    Finished predictions are appended to a manifest (JSON lines) in `output_dir`, so that a restarted job can skip
+    them with `is_done`.
 
-# Save colorized depth map
-depth_colored.save("./depth_colored.png")
\ No newline at end of file
+    Args:
+        output_dir (`str`):
+            Output directory, created if missing.
+        formats (`Sequence[str]`, *optional*, defaults to `("png16",)`):
+            Any of `"png16"` (depth as uint16 PNG), `"npy"` and `"npz"` (depth and uncertainty, compressed).
+        save_colored (`bool`, *optional*, defaults to `True`):
+            Also write the colorized depth map as PNG, if present.
+        num_workers (`int`, *optional*):
+            Number of encoder processes, defaults to the number of CPUs.
+        max_in_flight (`int`, *optional*):
+            Maximum number of queued predictions, defaults to twice the number of workers.
+        manifest_name (`str`, *optional*, defaults to `"manifest.jsonl"`):
+            File name of the manifest in `output_dir`.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        formats: Sequence[str] = ("png16",),
+        save_colored: bool = True,
+        num_workers: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        manifest_name: str = "manifest.jsonl",
+    ):
+        self.output_dir = output_dir
+        self.formats = tuple(formats)
+        self.save_colored = save_colored
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.num_workers
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.manifest_path = os.path.join(output_dir, manifest_name)
+        self.done = set()
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)["name"])
+                    except (ValueError, KeyError):
+                        # truncated last line of an interrupted job
+                        continue
+        self._manifest = open(self.manifest_path, "a")
+        # spawn, since the exporter is created after CUDA initialization and next to running prefetch threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.num_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._pending = {}
+
+    def is_done(self, name: str) -> bool:
+        """
+        Whether `name` has been written completely, in this or a previous run.
+        """
+        return name in self.done
+
+    def submit(self, name: str, output: MarigoldDepthOutput):
+        """
+        Queue a prediction for writing as `<output_dir>/<name>_depth.<ext>`. Blocks while `max_in_flight`
+        predictions are pending.
+        """
+        while len(self._pending) >= self.max_in_flight:
+            self._collect(return_when=FIRST_COMPLETED)
+        depth_colored = None
+        if self.save_colored and output.depth_colored is not None:
+            depth_colored = np.asarray(output.depth_colored)
+        future = self._executor.submit(
+            _export_depth_files,
+            self.output_dir,
+            name,
+            np.asarray(output.depth_np),
+            None if output.uncertainty is None else np.asarray(output.uncertainty),
+            depth_colored,
+            self.formats,
+        )
+        self._pending[future] = name
+
+    def export(self, outputs: Iterable[Tuple[str, MarigoldDepthOutput]], skip_done: bool = True) -> int:
+        """
+        Write a stream of `(name, output)` pairs, skipping names recorded in the manifest.
+
+        Returns:
+            `int`: Number of predictions written.
+        """
+        n_written = 0
+        for name, output in outputs:
+            if skip_done and self.is_done(name):
+                continue
+            self.submit(name, output)
+            n_written += 1
+        self._collect()
+        return n_written
+
+    def _collect(self, return_when=ALL_COMPLETED):
+        if not self._pending:
+            return
+        done, _ = wait(list(self._pending), return_when=return_when)
+        for future in done:
+            name = self._pending.pop(future)
+            files = future.result()
+            self.done.add(name)
+            self._manifest.write(json.dumps({"name": name, "files": files}) + "\n")
+        self._manifest.flush()
+
+    def close(self):
+        """
+        Wait for all pending writes and shut down the encoder processes.
+        """
+        try:
+            self._collect()
+        finally:
+            self._executor.shutdown()
+            self._manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+# --------------------------------------------------------------------------
+# Batch runner
+# --------------------------------------------------------------------------
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+EXAMPLE_IMAGE_URL = "https://share.phys.ethz.ch/~pf/bingkedata/marigold/pipeline_example.jpg"
+
+
+def list_inputs(input_path: str):
+    """
+    Resolve the runner input into `(name, path_or_url)` pairs.
+
+    `input_path` is either a directory (searched recursively for images), a manifest text file with one path or URL
+    per line, or a single image path or URL. Names are relative paths without extension and name the outputs. Local
+    paths of a manifest are taken relative to their common directory, URLs are named by their file name and a hash
+    of the URL, so that equal file names in different places do not overwrite each other.
+    """
+    if os.path.isdir(input_path):
+        inputs = []
+        for root, _, files in os.walk(input_path):
+            for file in files:
+                if file.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, file)
+                    inputs.append((os.path.splitext(os.path.relpath(path, input_path))[0], path))
+        return sorted(inputs)
+
+    if input_path.endswith(".txt"):
+        with open(input_path) as f:
+            paths = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    else:
+        paths = [input_path]
+
+    def is_url(path):
+        return path.startswith(("http://", "https://"))
+
+    local_dirs = [os.path.dirname(os.path.abspath(path)) for path in paths if not is_url(path)]
+    root = os.path.commonpath(local_dirs) if local_dirs else None
+    inputs = []
+    for path in paths:
+        if is_url(path):
+            stem = os.path.splitext(os.path.basename(path.split("?")[0]))[0]
+            name = f"{stem}_{hashlib.sha1(path.encode()).hexdigest()[:8]}"
+        else:
+            name = os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0]
+        inputs.append((name, path))
+    return inputs
+
+
+def read_manifests(output_dir: str):
+    """
+    Names already written to `output_dir`, from the manifests of all shards of previous runs.
+    """
+    done = set()
+    if not os.path.isdir(output_dir):
+        return done
+    for file in os.listdir(output_dir):
+        if file.startswith("manifest") and file.endswith(".jsonl"):
+            with open(os.path.join(output_dir, file)) as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line)["name"])
+                    except (ValueError, KeyError):
+                        continue
+    return done
+
+
+def prefetch_images(paths: Iterable[str], num_threads: int = 4, max_prefetch: int = 8):
+    """
+    Load and decode images in background threads, yielding them in order with at most `max_prefetch` ahead.
+    """
+    from diffusers.utils import load_image
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(load_image, path))
+            if len(pending) >= max_prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_shard(rank: int, world_size: int, inputs, args, result_queue=None):
+    """
+    Predict and export depth for the `rank`-th of `world_size` interleaved shards of `inputs`.
+
+    Returns:
+        `Tuple[int, float]`: Number of processed images and elapsed seconds.
+    """
+    inputs = inputs[rank::world_size]
+    if args.device == "cpu":
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+    pipe = MarigoldPipeline.from_pretrained(
+        args.checkpoint,
+        torch_dtype=torch.float16 if args.half_precision else torch.float32,
+        variant="fp16" if args.half_precision else None,
+    )
+    pipe.to(args.device)
+
+    worker_pool = None
+    if args.ensemble_workers > 0 and args.device == "cpu":
+        worker_pool = MarigoldEnsembleWorkerPool(
+            pipe,
+            num_workers=args.ensemble_workers,
+            num_threads=max(1, (os.cpu_count() or 1) // (world_size * args.ensemble_workers)),
+        )
+
+    start = time.perf_counter()
+    n_images = 0
+    with MarigoldDepthExporter(
+        args.output_dir,
+        formats=args.formats,
+        save_colored=args.color_map is not None,
+        num_workers=args.export_workers,
+        manifest_name=f"manifest_{rank:03d}.jsonl",
+    ) as exporter:
+        outputs = pipe.pipelined_call(
+            prefetch_images([path for _, path in inputs], num_threads=args.prefetch_threads),
+            denoising_steps=args.denoising_steps,
+            ensemble_size=args.ensemble_size,
+            processing_res=args.processing_res,
+            batch_size=args.batch_size,
+            seed=args.seed,
+            color_map=args.color_map,
+            frequency_scaling=args.frequency_scaling,
+            show_progress_bar=world_size == 1,
+            worker_pool=worker_pool,
+        )
+        for (name, _), output in zip(inputs, outputs):
+            exporter.submit(name, output)
+            n_images += 1
+            if n_images % args.log_every == 0:
+                elapsed = time.perf_counter() - start
+                logging.info(f"[shard {rank}] {n_images}/{len(inputs)} images, {n_images / elapsed:.2f} images/sec")
+    elapsed = time.perf_counter() - start
+    if worker_pool is not None:
+        worker_pool.close()
+
+    if result_queue is not None:
+        result_queue.put((rank, n_images, elapsed))
+    return n_images, elapsed
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run Marigold (with FreSca) depth estimation over a dataset.")
+    parser.add_argument(
+        "--input",
+        type=str,
+        default=EXAMPLE_IMAGE_URL,
+        help="Image directory, manifest .txt file (one path or URL per line), or single image path/URL.",
+    )
+    parser.add_argument("--output_dir", type=str, default="./output", help="Output directory.")
+    parser.add_argument("--checkpoint", type=str, default="prs-eth/marigold-v1-0", help="Checkpoint path or Hub id.")
+    parser.add_argument("--denoising_steps", type=int, default=10, help="Denoising steps per inference pass.")
+    parser.add_argument("--ensemble_size", type=int, default=10, help="Number of inference passes in the ensemble.")
+    parser.add_argument("--processing_res", type=int, default=768, help="Maximum processing resolution, 0 to keep.")
+    parser.add_argument("--batch_size", type=int, default=0, help="Inference batch size, 0 to plan automatically.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed.")
+    parser.add_argument("--color_map", type=str, default="Spectral", help="Colormap, 'none' to skip colorization.")
+    parser.add_argument("--frequency_scaling", action="store_true", help="Apply FreSca to the noise prediction.")
+    parser.add_argument("--half_precision", action="store_true", help="Run with half-precision (16-bit float).")
+    parser.add_argument(
+        "--formats", type=str, nargs="+", default=["png16"], choices=["png16", "npy", "npz"], help="Output formats."
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Inference device."
+    )
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of shard processes.")
+    parser.add_argument(
+        "--ensemble_workers", type=int, default=0, help="Processes sharing the ensemble of each image (CPU only)."
+    )
+    parser.add_argument("--export_workers", type=int, default=2, help="Encoder processes per shard.")
+    parser.add_argument("--prefetch_threads", type=int, default=4, help="Image loading threads per shard.")
+    parser.add_argument("--log_every", type=int, default=10, help="Report throughput every N images.")
+    args = parser.parse_args()
+    if args.color_map.lower() == "none":
+        args.color_map = None
+
+    logging.basicConfig(level=logging.INFO)
+
+    done = read_manifests(args.output_dir)
+    inputs = [(name, path) for name, path in list_inputs(args.input) if name not in done]
+    logging.info(f"{len(inputs)} images to process, {len(done)} already done.")
+    if not inputs:
+        return
+
+    world_size = max(1, min(args.num_workers, len(inputs)))
+    start = time.perf_counter()
+    if world_size == 1:
+        n_images, _ = run_shard(0, 1, inputs, args)
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        result_queue = ctx.Queue()
+        workers = [
+            ctx.Process(target=run_shard, args=(rank, world_size, inputs, args, result_queue))
+            for rank in range(world_size)
+        ]
+        for worker in workers:
+            worker.start()
+        n_images = 0
+        finished = set()
+        while len(finished) < world_size:
+            try:
+                rank, n_shard, elapsed = result_queue.get(timeout=5.0)
+            except queue.Empty:
+                # a crashed shard never reports back, its finished images are in its manifest
+                failed = [
+                    f"shard {rank} (exit code {worker.exitcode})"
+                    for rank, worker in enumerate(workers)
+                    if rank not in finished and not worker.is_alive()
+                ]
+                if failed:
+                    for worker in workers:
+                        worker.terminate()
+                    raise RuntimeError(
+                        "Shard processes failed: " + ", ".join(failed) + ". Rerun to resume the remaining images."
+                    )
+                continue
+            finished.add(rank)
+            logging.info(f"[shard {rank}] finished {n_shard} images in {elapsed:.1f}s")
+            n_images += n_shard
+        for worker in workers:
+            worker.join()
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"Processed {n_images} images in {elapsed:.1f}s ({n_images / elapsed:.2f} images/sec).")
+
+
+if __name__ == "__main__":
+    main()
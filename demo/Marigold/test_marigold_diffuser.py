@@ -0,0 +1,19 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from marigold_diffuser import _export_depth_files
+
+
+def test_export_png16_keeps_float_depth_for_npy(tmp_path):
+    depth = np.random.default_rng(0).random((8, 8), dtype=np.float32)
+
+    files = _export_depth_files(str(tmp_path), "img", depth, None, None, ("png16", "npy"))
+
+    assert sorted(os.path.basename(f) for f in files) == ["img_depth.npy", "img_depth.png"]
+    depth_npy = np.load(tmp_path / "img_depth.npy")
+    assert depth_npy.dtype == np.float32
+    np.testing.assert_array_equal(depth_npy, depth)
+    depth_png = np.asarray(Image.open(tmp_path / "img_depth.png"))
+    np.testing.assert_array_equal(depth_png, (depth * 65535.0).round().astype(np.uint16))